@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Kyle Hernandez
+khernandez@bsd.uchicago.edu
+Center for Research Informatics
+University of Chicago
+"""
+import sys
+import argparse
+import multiprocessing
+import ShortCSFilter
+
+def usage():
+    """Prints usage to the screen"""
+    print """
+-------------------------------------------------------------------------------
+Author: Kyle Hernandez <khernandez@bsd.uchicago.edu>
+
+Description: Runs ShortCSFilter.py on every sample of a population in one
+process pool. Each sample gets its own <filtered.fq> and '.trim_stats' file and
+the statistics of all samples are combined into a single table.
+
+Manifest: Tab-delimited file with one sample per line and the columns
+	sample  raw.fa  raw.qual  filtered.fq
+Blank lines and lines starting with '#' are skipped.
+
+Usage:
+	BatchShortCSFilter.py [options] <manifest.txt> <trim_stats.txt>
+
+Options:
+	--jobs N        Number of samples filtered at the same time (default 4).
+	                Keep this near the number of disks feeding the jobs.
+	--batch-size N  Passed on to ShortCSFilter.py (default 50000)
+	--checkpoint N  Passed on to ShortCSFilter.py (default 1000000)
+	--resume        Continue interrupted samples from their last checkpoint
+-------------------------------------------------------------------------------
+"""
+
+def get_args():
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(
+        usage='BatchShortCSFilter.py [options] <manifest.txt> <trim_stats.txt>')
+    parser.add_argument('manifest')
+    parser.add_argument('o_stats')
+    parser.add_argument('--jobs', type=int, default=4,
+        help='number of samples filtered at the same time [%(default)s]')
+    parser.add_argument('--batch-size', type=int, default=ShortCSFilter.batch,
+        help='reads per vectorized batch, 0 disables batching [%(default)s]')
+    parser.add_argument('--checkpoint', type=int, default=ShortCSFilter.checkpoint,
+        help='reads between checkpoints, 0 disables them [%(default)s]')
+    parser.add_argument('--resume', action='store_true',
+        help='continue interrupted samples from their last checkpoint')
+    return parser.parse_args()
+
+def load_manifest(manifest):
+    """
+    Reads the sample manifest
+    @param manifest - tab-delimited sample, csfasta, csqual, fastq file
+    @returns list of (sample, csfasta, csqual, fastq) tuples
+    """
+    rows = []
+    for line in open(manifest, 'rU'):
+        if not line.strip() or line.startswith('#'): continue
+        cols = line.rstrip().split('\t')
+        assert len(cols) == 4, 'ERROR!! Manifest line needs 4 columns:\n{0}'.format(line)
+        rows.append(tuple(cols))
+    return rows
+
+def process_sample(args):
+    """
+    Filters a single sample in a worker process and writes its stats file
+    @returns dictionary of filtering statistics
+    """
+    sample, in_fasta, in_qual, o_fq, batch_size, every, resume = args
+    cts = ShortCSFilter.process_files(in_fasta, in_qual, o_fq, batch_size, None, every, resume)
+    ShortCSFilter.write_stats(o_fq + '.trim_stats', cts)
+    print >> sys.stderr, 'Finished', sample
+    return cts
+
+def write_table(o_stats, samples, results):
+    """
+    Writes the statistics of every sample into one table
+    @param o_stats - output table
+    @param samples - sample names in manifest order
+    @param results - dictionary of filtering statistics of each sample
+    """
+    keys = ['total', 'lengths', 'missing', 'lowqual', 'homopolymer', 'passed']
+    runs = sorted(set(n for cts in results for n in cts['runs']))
+    with open(o_stats, 'wb') as o:
+        o.write('\t'.join(['sample'] + keys + ['longest_run_' + str(n) for n in runs]) + '\n')
+        for s, cts in zip(samples, results):
+            row = [s] + [str(cts[k]) for k in keys] + [str(cts['runs'].get(n, 0)) for n in runs]
+            o.write('\t'.join(row) + '\n')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        usage()
+        sys.exit(1)
+
+    # Command line args
+    args  = get_args()
+    rows  = load_manifest(args.manifest)
+    tasks = [r + (args.batch_size, args.checkpoint, args.resume) for r in rows]
+
+    # Filter the samples; one task per worker keeps memory from building up
+    pool = multiprocessing.Pool(max(1, min(args.jobs, len(tasks))), maxtasksperchild=1)
+    try:
+        results = pool.map(process_sample, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Write combined stats
+    write_table(args.o_stats, [r[0] for r in rows], results)
@@ -6,6 +6,11 @@ Center for Research Informatics
 University of Chicago
 """
 import sys
+from itertools import islice
+import numpy as np
+import markermatrix
+
+chunk = 100000
 
 def usage():
     """Prints usage to the screen"""
@@ -20,12 +25,104 @@ Notes:
 - Missing frequency cutoff of 0.30 
 - A freq/B freq cutoff 0.60
 - H freq cutoff 0.30 
+- Markers are filtered in chunks of 100,000 lines with vectorized counts, so
+memory use does not grow with the size of the matrix
+- Either matrix can be text or 2-bit binary (.mkb, see markermatrix.py); binary
+input is filtered straight from the packed genotypes
 
 Usage:
         FilterMarkers.py <markers.raw.txt> <markers.filtered.txt>
 -------------------------------------------------------------------------------
 """
 
+def passes(line):
+    """Applies the cutoffs to a single marker line"""
+    cols  = line.rstrip().split('\t')
+    calls = cols[1:]
+    # Get missing freq
+    fmiss = calls.count('N') / float(len(calls))
+    if fmiss < 0.30:
+        # Get allele freqs
+        nomiss = [i for i in calls if i != 'N']
+        afreq  = nomiss.count('A') / float(len(nomiss))
+        bfreq  = nomiss.count('B') / float(len(nomiss))
+        hfreq  = nomiss.count('H') / float(len(nomiss))
+        return afreq < 0.60 and bfreq < 0.60 and hfreq < 0.30
+    return False
+
+def filterChunk(lines):
+    """
+    Applies the cutoffs to a chunk of marker lines at once. The calls are
+    loaded into a (markers x samples) character matrix and counted along
+    the sample axis. Chunks with calls longer than one character are
+    filtered line by line.
+    @param lines - list of marker lines
+    @returns list of the lines that pass
+    """
+    calls = [i.rstrip()[i.index('\t') + 1:] for i in lines]
+    width = len(calls[0])
+    if len(set(map(len, calls))) != 1:
+        return [i for i in lines if passes(i)]
+
+    mat = np.frombuffer(''.join(calls), dtype=np.uint8).reshape(len(calls), width)
+    if not (mat[:, 1::2] == ord('\t')).all():
+        return [i for i in lines if passes(i)]
+    keep = keepMask(mat[:, ::2], [ord(i) for i in 'NABH'])
+    return [lines[i] for i in np.flatnonzero(keep)]
+
+def keepMask(mat, codes):
+    """
+    Applies the cutoffs to a (markers x samples) matrix of calls
+    @param mat - 2-D array of calls
+    @param codes - values of the missing, A, B and H calls in the matrix
+    @returns boolean array of the markers that pass
+    """
+    n, a, b, h = codes
+    # Get missing and allele freqs
+    total  = float(mat.shape[1])
+    miss   = np.count_nonzero(mat == n, axis=1)
+    nomiss = (mat.shape[1] - miss).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        afreq = np.count_nonzero(mat == a, axis=1) / nomiss
+        bfreq = np.count_nonzero(mat == b, axis=1) / nomiss
+        hfreq = np.count_nonzero(mat == h, axis=1) / nomiss
+    return (miss / total < 0.30) & (afreq < 0.60) & (bfreq < 0.60) & (hfreq < 0.30)
+
+def filterMarkers(lines, size=chunk):
+    """
+    Yields the header and the marker lines that pass the missing data and
+    allele frequency cutoffs, working through the markers in chunks
+    @param lines - iterable of raw marker lines, starting with the header
+    @param size - number of marker lines per chunk
+    """
+    lines = iter(lines)
+    for line in lines:
+        yield line
+        break
+
+    block = list(islice(lines, size))
+    while block:
+        for line in filterChunk(block):
+            yield line
+        block = list(islice(lines, size))
+
+def filterMatrix(mat, o, size=chunk):
+    """
+    Filters a binary marker matrix without going through text
+    @param mat - markermatrix.MarkerMatrix
+    @param o - output from markermatrix.open_output
+    @param size - number of markers per chunk
+    """
+    binary = isinstance(o, markermatrix.MarkerWriter)
+    if binary: o.start(mat.samples, mat.columns, mat.missing)
+    else: o.write(mat.header())
+    for rows, codes in mat.chunks(size):
+        keep  = np.flatnonzero(keepMask(codes, range(4)))
+        rows  = [rows[i] for i in keep]
+        codes = codes[keep]
+        if binary: o.write_codes(rows, codes)
+        else: o.write(markermatrix.format_lines(rows, codes, mat.missing))
+
 if __name__ == '__main__':
     if len(sys.argv) != 3:
         usage()
@@ -36,22 +133,10 @@ if __name__ == '__main__':
     ofil = sys.argv[2]
 
     # Process file 
-    head = []
-    with open(ofil, 'wb') as o:
-        for line in open(ifil, 'rU'):
-            if not head:
-                head = line.rstrip().split('\t')
+    with markermatrix.open_output(ofil) as o:
+        fh = markermatrix.open_input(ifil)
+        if isinstance(fh, markermatrix.MarkerMatrix):
+            filterMatrix(fh, o)
+        else:
+            for line in filterMarkers(fh):
                 o.write(line)
-            else:
-                cols  = line.rstrip().split('\t')
-                calls = cols[1:]
-                # Get missing freq
-                fmiss = calls.count('N') / float(len(calls))
-                if fmiss < 0.30:
-                    # Get allele freqs
-                    nomiss = [i for i in calls if i != 'N']
-                    afreq  = nomiss.count('A') / float(len(nomiss))
-                    bfreq  = nomiss.count('B') / float(len(nomiss))
-                    hfreq  = nomiss.count('H') / float(len(nomiss))
-                    if afreq < 0.60 and bfreq < 0.60 and hfreq < 0.30:
-                        o.write(line)
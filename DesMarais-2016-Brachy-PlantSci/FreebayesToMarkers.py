@@ -6,6 +6,19 @@ Center for Research Informatics
 University of Chicago
 """
 import sys
+import argparse
+from itertools import chain
+from operator import itemgetter
+import numpy as np
+import vcfregions
+import markermatrix
+
+# Parent Sample IDs
+parentA = 'BD_Bd21'
+parentB = 'BD_Bd3-1'
+
+# GT and GQ positions of every FORMAT string seen so far
+formats = {}
 
 def usage():
     """Prints usage to the screen"""
@@ -23,18 +36,66 @@ Notes:
 inferred where possible.
 
 Usage:
-	FreebayesToMarkers.py <freebayes.biallelic.vcf> <markers.raw.txt>
+	FreebayesToMarkers.py [options] <freebayes.biallelic.vcf> <markers.raw.txt>
+
+Options:
+	--threads N     Process the VCF one region at a time in N processes
+	--regions R     Only process these regions, given as a file with one
+	                region per line or a comma-separated list of 'contig' or
+	                'contig:start-end'. Output is always in genomic order.
+
+Regions are read through a block index (<vcf>.ridx) that is built on first use,
+so the VCF must be uncompressed and sorted.
+
+Markers are written as a 2-bit binary matrix when the output ends with .mkb
+(see markermatrix.py).
 -------------------------------------------------------------------------------
 """
 
-def getGenotype(d, g):
+def get_args():
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(
+        usage='FreebayesToMarkers.py [options] <freebayes.biallelic.vcf> <markers.raw.txt>')
+    parser.add_argument('ifil')
+    parser.add_argument('ofil')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of regions processed at the same time [%(default)s]')
+    parser.add_argument('--regions', default=None,
+        help='file or comma-separated list of regions to process')
+    return parser.parse_args()
+
+def format_index(fmt):
+    '''
+    Returns the GT and GQ positions of a FORMAT string. Each distinct FORMAT
+    string is only parsed once.
+    '''
+    try:
+        return formats[fmt]
+    except KeyError:
+        keys = fmt.split(':')
+        formats[fmt] = (keys.index('GT'), keys.index('GQ'))
+        return formats[fmt]
+
+def getGenotypes(fmt, fields):
+    '''
+    Parses out the genotype calls of a list of samples and applies GQ filter
+    of 8. Each sample is only split as far as its GT and GQ fields.
+    '''
+    gt, gq = format_index(fmt)
+    last   = max(gt, gq) + 1
+    calls  = []
+    for g in fields:
+        curr = g.split(':', last)
+        if curr[gt] == '.': calls.append(None)
+        elif int(curr[gq]) < 8: calls.append(None)
+        else: calls.append(curr[gt])
+    return calls
+
+def getGenotype(fmt, g):
     '''
     Parses out the genotype call and applies GQ filter of 8
     '''
-    curr = dict(zip(d, g.split(':')))
-    if curr['GT'] == '.': return None
-    elif int(curr['GQ']) < 8: return None
-    else: return curr['GT']
+    return getGenotypes(fmt, [g])[0]
 
 def is_het(g):
     '''
@@ -90,48 +151,155 @@ def getMarkers(pa, pb, gts):
     return curr
 
 
+class MarkerTable(object):
+    '''
+    Translation tables from genotype codes to A/B/H/N marker calls. Every
+    distinct genotype string gets a small integer code and every parental
+    configuration gets one row of calls built with getMarkers, so a block of
+    sites is called with a single lookup into a 2-D table.
+    '''
+    def __init__(self):
+        self.codes   = {None: 0}
+        self.vocab   = [None]
+        self.configs = {}
+        self.rows    = []
+        self.emit    = []
+        self.table   = None
+
+    def _call(self, pa, pb, g):
+        markers = getMarkers(pa, pb, [g])
+        return markers[0] if markers else 'N'
+
+    def encode(self, gts):
+        '''
+        Returns the codes of a list of genotype calls, adding new calls to
+        every existing table row
+        '''
+        try:
+            return [self.codes[g] for g in gts]
+        except KeyError:
+            for g in gts:
+                if g in self.codes: continue
+                self.codes[g] = len(self.vocab)
+                self.vocab.append(g)
+                for (pa, pb), n in self.configs.iteritems():
+                    self.rows[n].append(self._call(pa, pb, g))
+                self.table = None
+            return [self.codes[g] for g in gts]
+
+    def config(self, pa, pb):
+        '''
+        Returns the table row for a pair of parental genotypes and whether
+        sites with these parents are written at all
+        '''
+        key = (pa, pb)
+        if key not in self.configs:
+            skip    = is_het(pa) or is_het(pb) or bool((pa and pb) and (pa == pb))
+            markers = getMarkers(pa, pb, self.vocab)
+            self.configs[key] = len(self.rows)
+            self.rows.append(markers or ['N'] * len(self.vocab))
+            self.emit.append(not skip and bool(markers))
+            self.table = None
+        n = self.configs[key]
+        return n, self.emit[n]
+
+    def call(self, cfg, gts):
+        '''
+        Calls a block of sites
+        @param cfg - table row of each site
+        @param gts - 2-D array of genotype codes, sites by samples
+        @returns 2-D uint8 array of marker call characters
+        '''
+        if self.table is None:
+            self.table = np.array([[ord(c) for c in r] for r in self.rows], dtype=np.uint8)
+        return self.table[np.asarray(cfg)[:, None], gts]
+
+def writeBlock(table, names, cfg, codes):
+    '''
+    Calls a block of sites and returns the tab-delimited marker lines
+    '''
+    if not names: return ''
+    calls = table.call(cfg, np.array(codes, dtype=np.intp))
+    out   = np.empty((calls.shape[0], 2 * calls.shape[1]), dtype=np.uint8)
+    out[:, 0::2] = calls
+    out[:, 1::2] = ord('\t')
+    out[:, -1]   = ord('\n')
+    return ''.join(n + '\t' + r.tostring() for n, r in zip(names, out))
+
+def callMarkers(lines, block=10000):
+    '''
+    Converts VCF lines into marker lines, starting with the header. Sites
+    are called in blocks with a MarkerTable.
+    '''
+    table = MarkerTable()
+    samples = []
+    names, cfg, codes = [], [], []
+
+    for line in lines:
+        if line.startswith('##'): continue
+        elif line.startswith('#CHROM'):
+            head = line.rstrip().split('\t')
+            samples = head[9:-2]
+            yield '\t'.join(['marker'] + samples) + '\n'
+
+            # Column of each sample, the last one if a name is repeated
+            col  = dict((h, i) for i, h in enumerate(head))
+            ril  = [col[i] for i in samples]
+            cols = itemgetter(col['#CHROM'], col['POS'], col['FORMAT'], col[parentA], col[parentB])
+        else:
+            row = line.rstrip().split('\t')
+            chrom, pos, fmt, gA, gB = cols(row)
+
+            # Extract the parental genotypes and skip sites that are not markers
+            pgt_A, pgt_B = getGenotypes(fmt, [gA, gB])
+            n, emit = table.config(pgt_A, pgt_B)
+            if not emit or not samples: continue
+
+            # Extract the RIL genotypes
+            gt_calls = getGenotypes(fmt, [row[i] for i in ril])
+            names.append(chrom + ':' + pos)
+            cfg.append(n)
+            codes.append(table.encode(gt_calls))
+
+            # Call markers
+            if len(names) >= block:
+                yield writeBlock(table, names, cfg, codes)
+                names, cfg, codes = [], [], []
+
+    yield writeBlock(table, names, cfg, codes)
+
+def callRegion(args):
+    '''
+    Calls the markers of one region of an indexed VCF into a part file,
+    without the header line
+    '''
+    ifil, index, region, part = args
+    lines = chain(vcfregions.read_header(ifil, index), vcfregions.fetch(ifil, index, region))
+    out = callMarkers(lines)
+    next(out)
+    with open(part, 'wb') as o:
+        for i in out:
+            o.write(i)
+    return part
+
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
+    if len(sys.argv) < 3:
         usage()
         sys.exit(1)
 
     # Command line args
-    ifil = sys.argv[1]
-    ofil = sys.argv[2]
+    args = get_args()
+    ifil = args.ifil
+    ofil = args.ofil
 
     # Start processing file    
-    with open(ofil, 'wb') as o:
-        head = []
-        samples = []
-
-        # Parent Sample IDs
-        parentA = 'BD_Bd21'
-        parentB = 'BD_Bd3-1'
-
-        # process input vcf
-        for line in open(ifil, 'rU'):
-            if line.startswith('##'): continue
-            elif line.startswith('#CHROM'):
-                head = line.rstrip().split('\t')
-                samples = head[9:-2]
-                o.write('\t'.join(['marker'] + samples) + '\n')
-            else:
-                dat = dict(zip(head, line.rstrip().split('\t')))
-                fmt = dat['FORMAT'].split(':')
-
-                # Extract the parental genotypes
-                pgt_A = getGenotype(fmt, dat[parentA])
-                pgt_B = getGenotype(fmt, dat[parentB])
-
-                # Extract the RIL genotypes
-                gt_calls = [getGenotype(fmt, dat[i]) for i in samples]
-
-                # Call markers
-                markers = []
-
-                if is_het(pgt_A) or is_het(pgt_B): continue
-                elif (pgt_A and pgt_B) and (pgt_A == pgt_B): continue
-                else:
-                    markers = getMarkers(pgt_A, pgt_B, gt_calls)
-                    if markers:
-                        o.write('\t'.join(['{#CHROM}:{POS}'.format(**dat)] + markers) + '\n')
+    with markermatrix.open_output(ofil) as o:
+        if args.threads > 1 or args.regions:
+            index   = vcfregions.load_index(ifil)
+            regions = vcfregions.sorted_regions(index, args.regions and vcfregions.read_regions(args.regions))
+            tasks   = [(ifil, index, r, '{0}.region{1:04d}'.format(ofil, n)) for n, r in enumerate(regions)]
+            o.write(next(callMarkers(vcfregions.read_header(ifil, index))))
+            vcfregions.join_parts(vcfregions.map_regions(callRegion, tasks, args.threads), o)
+        else:
+            for out in callMarkers(open(ifil, 'rU')):
+                o.write(out)
@@ -6,7 +6,18 @@ Center for Research Informatics
 University of Chicago
 """
 import sys
+import os
+import mmap
+import argparse
+from itertools import islice, takewhile
+import numpy as np
 from scipy import stats 
+import vcfregions
+import qsketch
+
+# (byte offset, QUAL) of every PASS record, saved by the first pass
+spill_dtype = np.dtype([('offset', '<u8'), ('qual', '<f8')])
+chunk = 100000
 
 def usage():
     """Prints usage to the screen"""
@@ -22,56 +33,259 @@ Notes:
 - Only processes loci with 'PASS' in the FILTER column
 - Only processes loci where at least one sample has a SNP GT > 90
 Usage:
-	GetHighQualSNPs.py <input.vcf> <output.vcf> 
+	GetHighQualSNPs.py [options] <input.vcf> <output.vcf> 
+
+Options:
+	--threads N     Process the VCF one region at a time in N processes
+	--regions R     Only process these regions, given as a file with one
+	                region per line or a comma-separated list of 'contig' or
+	                'contig:start-end'. The 90th percentile is then taken
+	                over the selected regions only.
+
+	--exact         Keep every PASS QUAL in memory and take the exact 90th
+	                percentile (the original behavior)
+	--accuracy A    Relative accuracy of the QUAL sketch used otherwise
+	                (default 0.001, i.e. the cutoff is within 0.1%)
+	--sketch-only   Write the QUAL sketch of the input to <output> and stop
+	--sketches S    Take the cutoff from the merged sketches S (a file with one
+	                sketch per line or a comma-separated list) instead of
+	                reading the input for it. The accuracy is the one the
+	                sketches were made with.
+
+Regions are read through a block index (<vcf>.ridx) that is built on first use,
+so the VCF must be uncompressed and sorted.
+
+The first pass saves the offset and QUAL of every PASS record next to the output
+(<output>.quals, removed at the end), so the second pass only reads the records
+above the cutoff.
+
+The QUAL sketches of per-chromosome VCFs can be made in parallel with
+--sketch-only and merged with --sketches, so every chromosome is filtered with
+the same genome-wide cutoff.
 -------------------------------------------------------------------------------
 """
 
-def extract_quals():
-    """Extracts the quality scores and returns the 90th percentile cutoff"""
-    AQ = []
-    for line in open(fil, 'rU'):
+def get_args():
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(
+        usage='GetHighQualSNPs.py [options] <input.vcf> <output.vcf>')
+    parser.add_argument('fil')
+    parser.add_argument('ofil')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of regions processed at the same time [%(default)s]')
+    parser.add_argument('--regions', default=None,
+        help='file or comma-separated list of regions to process')
+    parser.add_argument('--exact', action='store_true',
+        help='keep every QUAL and take the exact percentile')
+    parser.add_argument('--accuracy', type=float, default=qsketch.accuracy,
+        help='relative accuracy of the QUAL sketch [%(default)s]')
+    parser.add_argument('--sketch-only', action='store_true',
+        help='only write the QUAL sketch of the input to <output>')
+    parser.add_argument('--sketches', default=None,
+        help='file or comma-separated list of QUAL sketches to take the cutoff from')
+    args = parser.parse_args()
+    if args.exact and (args.sketch_only or args.sketches):
+        parser.error('--exact cannot be used with --sketch-only or --sketches')
+    return args
+
+def read_records(fil):
+    """Yields the (byte offset, line) of every line of a VCF"""
+    pos = 0
+    with open(fil, 'rb') as fh:
+        for line in fh:
+            yield pos, line
+            pos += len(line)
+
+def pass_quals(records):
+    """Yields the (byte offset, quality score) of the PASS loci"""
+    for pos, line in records:
         if line.startswith('#'): continue
         else:
-            cols = line.rstrip().split('\t')
+            cols = line.rstrip().split('\t', 7)
             flt  = cols[6]
             if flt == 'PASS':
-                AQ.append(float(cols[5])) 
+                yield pos, float(cols[5])
+
+def extract_quals(records, exact=False, alpha=qsketch.accuracy, spill=None):
+    """
+    Extracts the quality scores of the PASS loci
+    @param records - (byte offset, line) pairs
+    @param spill - optional file to save the (offset, QUAL) of the PASS loci to
+    @returns list of every score in exact mode, otherwise a QuantileSketch
+    """
+    AQ  = [] if exact else qsketch.QuantileSketch(alpha)
+    out = open(spill, 'wb') if spill else None
+    try:
+        recs  = pass_quals(records)
+        block = list(islice(recs, chunk))
+        while block:
+            arr = np.array(block, dtype=spill_dtype)
+            if out: arr.tofile(out)
+            if exact: AQ.extend(arr['qual'].tolist())
+            else: AQ.add(arr['qual'])
+            block = list(islice(recs, chunk))
+    finally:
+        if out: out.close()
+    return AQ
+
+def merge_quals(parts, exact=False, alpha=qsketch.accuracy):
+    """
+    Merges the score lists or sketches of several regions. The merged sketch
+    takes the accuracy of the first one, alpha is only used when there are none.
+    """
+    if exact: return [q for part in parts for q in part]
+    sk = None
+    for part in parts:
+        if sk is None: sk = qsketch.QuantileSketch(part.alpha)
+        sk.merge(part)
+    return sk or qsketch.QuantileSketch(alpha)
+
+def load_sketches(paths):
+    """Loads QUAL sketches, which must all have been made with the same accuracy"""
+    sketches = [qsketch.load(i) for i in paths]
+    for path, sk in zip(paths, sketches):
+        if sk.alpha != sketches[0].alpha:
+            raise ValueError('ERROR!! The sketch {0} has accuracy {1!r} but {2} has {3!r}; '
+                             'make them with the same --accuracy'.format(
+                             path, sk.alpha, paths[0], sketches[0].alpha))
+    return sketches
+
+def get_cutoff(AQ):
+    """Returns the 90th percentile of a score list or sketch"""
+    if isinstance(AQ, qsketch.QuantileSketch):
+        return AQ.quantile(0.90)
     return stats.scoreatpercentile(AQ, 90)
 
-def filter_vcf(percentile):
+def good_call(cols):
+    """Checks for a sample with a non-reference call and a GQ > 90"""
+    fmt = cols[8].split(':')
+    idx = fmt.index('GQ')
+    called = [i.split(':') for i in cols[9:] if i.split(':')[0] != './.']
+    good   = [i for i in called if i[0] != '0/0' and int(i[idx]) > 90] 
+    return bool(good)
+
+def unix_line(line):
+    """Ends a line read in binary mode with '\\n', like reading in 'rU' mode"""
+    if line.endswith('\r\n'): return line[:-2] + '\n'
+    return line
+
+def filter_vcf(lines, percentile, o):
     """Applies the filtering"""
-    with open(ofil, 'wb') as o:
-        head = []
-        samples = []
-        for line in open(fil, 'rU'):
-            if line.startswith('##'): o.write(line) 
-            elif line.startswith('#'):
-                o.write(line)
-                head = line.rstrip().split('\t')
-                samples = head[9:]
-            else:
-                cols = line.rstrip().split('\t')
-                flt  = cols[6]
-                qual = float(cols[5])
-                if flt == 'PASS' and qual > percentile:
-                    fmt = cols[8].split(':')
-                    idx = fmt.index('GQ')
-                    called = [i.split(':') for i in cols[9:] if i.split(':')[0] != './.']
-                    good   = [i for i in called if i[0] != '0/0' and int(i[idx]) > 90] 
-                    if good: 
-                        o.write(line)
+    head = []
+    samples = []
+    for line in lines:
+        if line.startswith('##'): o.write(unix_line(line))
+        elif line.startswith('#'):
+            o.write(unix_line(line))
+            head = line.rstrip().split('\t')
+            samples = head[9:]
+        else:
+            cols = line.rstrip().split('\t')
+            flt  = cols[6]
+            qual = float(cols[5])
+            if flt == 'PASS' and qual > percentile:
+                if good_call(cols): 
+                    o.write(unix_line(line))
+
+def filter_spill(fil, spill, percentile, o):
+    """
+    Applies the filtering to the records saved in a spill file. Only the
+    records above the cutoff are read from the VCF, straight from their
+    offsets.
+    """
+    if not os.path.getsize(spill): return
+    recs = np.memmap(spill, dtype=spill_dtype, mode='r')
+    offs = recs['offset'][recs['qual'] > percentile]
+    if not offs.size: return
+    with open(fil, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for pos in offs.tolist():
+            end  = mm.find('\n', pos)
+            line = mm[pos:end + 1] if end >= 0 else mm[pos:]
+            if good_call(line.rstrip().split('\t')):
+                o.write(unix_line(line))
+    finally:
+        mm.close()
+
+def region_quals(args):
+    """Extracts the quality scores of one region of an indexed VCF"""
+    fil, index, region, exact, alpha, spill = args
+    return extract_quals(vcfregions.fetch_records(fil, index, region), exact, alpha, spill)
+
+def region_filter(args):
+    """Filters one region of an indexed VCF into a part file"""
+    fil, index, region, percentile, spill, part = args
+    with open(part, 'wb') as o:
+        if spill:
+            filter_spill(fil, spill, percentile, o)
+            os.remove(spill)
+        else:
+            filter_vcf(vcfregions.fetch(fil, index, region), percentile, o)
+    return part
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
+    if len(sys.argv) < 3:
         usage()
         sys.exit(1)
 
     # Command line args
-    fil  = sys.argv[1] 
-    ofil = sys.argv[2] 
+    args = get_args()
+    fil  = args.fil
+    ofil = args.ofil
+
+    split = args.threads > 1 or args.regions
+    if split:
+        index   = vcfregions.load_index(fil)
+        regions = vcfregions.sorted_regions(index, args.regions and vcfregions.read_regions(args.regions))
+        spills  = ['{0}.region{1:04d}.quals'.format(ofil, n) for n in xrange(len(regions))]
+        parts   = ['{0}.region{1:04d}'.format(ofil, n) for n in xrange(len(regions))]
+    else:
+        spills  = [ofil + '.quals']
+        parts   = []
+    if args.sketch_only or args.sketches:
+        spills  = [None] * len(spills)
 
-    # Get 90th percentile cutoff
-    percentile = extract_quals()
+    try:
+        # Get 90th percentile cutoff
+        if args.sketches:
+            AQ = merge_quals(load_sketches(vcfregions.read_regions(args.sketches)))
+        else:
+            if split:
+                tasks = [(fil, index, r, args.exact, args.accuracy, sp) for r, sp in zip(regions, spills)]
+                quals = vcfregions.map_regions(region_quals, tasks, args.threads)
+                try:
+                    AQ = merge_quals(quals, args.exact, args.accuracy)
+                finally:
+                    quals.close()
+            else:
+                AQ = merge_quals([extract_quals(read_records(fil), args.exact, args.accuracy, spills[0])],
+                                 args.exact, args.accuracy)
+            if args.sketch_only:
+                AQ.save(ofil)
+                sys.exit(0)
+        percentile = get_cutoff(AQ)
 
-    # Apply filters
-    filter_vcf(percentile)
+        # Apply filters
+        with open(ofil, 'wb') as o:
+            if split:
+                tasks = [(fil, index, r, percentile, sp, part)
+                         for r, sp, part in zip(regions, spills, parts)]
+                filter_vcf(vcfregions.read_header(fil, index), percentile, o)
+                done = vcfregions.map_regions(region_filter, tasks, args.threads)
+                try:
+                    vcfregions.join_parts(done, o)
+                finally:
+                    done.close()
+            elif spills[0]:
+                with open(fil, 'rU') as fh:
+                    filter_vcf(takewhile(lambda i: i.startswith('#'), fh), percentile, o)
+                filter_spill(fil, spills[0], percentile, o)
+            else:
+                with open(fil, 'rU') as fh:
+                    filter_vcf(fh, percentile, o)
+    finally:
+        # Spill and part files are not kept, also when an error or an
+        # interrupt stops the run
+        for i in spills + parts:
+            if i and os.path.exists(i): os.remove(i)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Kyle Hernandez
+khernandez@bsd.uchicago.edu
+Center for Research Informatics
+University of Chicago
+"""
+import sys
+import argparse
+import threading
+import subprocess
+import FreebayesToMarkers
+import FilterMarkers
+import markermatrix
+
+minqual = 15.0
+
+def usage():
+    """Prints usage to the screen"""
+    print """
+-------------------------------------------------------------------------------
+Author: Kyle Hernandez <khernandez@bsd.uchicago.edu>
+
+Description: Runs Steps 03-04 from the raw freebayes VCF to the filtered
+marker matrix in one pass. The biallelic/QUAL filter, the optional Vt
+normalization, FreebayesToMarkers.py and FilterMarkers.py are chained as
+streaming stages, so the output is the same as running the steps one after
+the other but nothing in between is written to disk.
+
+Usage:
+	MarkerPipeline.py [options] <freebayes.raw.vcf> <markers.filtered.txt>
+
+	Use '-' as the input to read the VCF from stdin.
+
+Options:
+	--reference FA      Normalize the biallelic loci with 'vt normalize'
+	                    against this reference. Without it the input is
+	                    expected to be normalized already.
+	--vt PATH           Vt executable (default 'vt')
+	--min-qual Q        Minimum QUAL of the biallelic loci (default 15)
+	--biallelic-vcf F   Also write the biallelic loci to this file
+	--raw-markers F     Also write the unfiltered marker matrix to this file
+
+The filtered markers are written as a 2-bit binary matrix when the output ends
+with .mkb (see markermatrix.py).
+-------------------------------------------------------------------------------
+"""
+
+def get_args():
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(
+        usage='MarkerPipeline.py [options] <freebayes.raw.vcf> <markers.filtered.txt>')
+    parser.add_argument('ifil')
+    parser.add_argument('ofil')
+    parser.add_argument('--reference', default=None,
+        help='reference fasta for vt normalize, skipped when not given')
+    parser.add_argument('--vt', default='vt',
+        help='vt executable [%(default)s]')
+    parser.add_argument('--min-qual', type=float, default=minqual,
+        help='minimum QUAL of the biallelic loci [%(default)s]')
+    parser.add_argument('--biallelic-vcf', default=None,
+        help='also write the biallelic loci to this file')
+    parser.add_argument('--raw-markers', default=None,
+        help='also write the unfiltered marker matrix to this file')
+    return parser.parse_args()
+
+def biallelic(lines, qual=minqual):
+    """
+    Yields the header lines and the biallelic loci with QUAL >= qual. Loci
+    with a missing QUAL are removed.
+    """
+    for line in lines:
+        if line.startswith('#'):
+            yield line
+            continue
+        cols = line.split('\t', 6)
+        if ',' in cols[3] or ',' in cols[4]: continue
+        try:
+            if float(cols[5]) >= qual:
+                yield line
+        except ValueError:
+            continue
+
+def normalize(lines, vt, reference):
+    """
+    Streams VCF lines through 'vt normalize' and yields its output. The
+    input is fed to vt from a separate thread so both ends keep moving.
+    """
+    proc = subprocess.Popen([vt, 'normalize', '-r', reference, '-o', '-', '-'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    error = []
+
+    def feed():
+        try:
+            for line in lines:
+                proc.stdin.write(line)
+        except Exception as e:
+            error.append(e)
+        finally:
+            proc.stdin.close()
+
+    thread = threading.Thread(target=feed)
+    thread.daemon = True
+    thread.start()
+    for line in iter(proc.stdout.readline, ''):
+        yield line
+    thread.join()
+    if error: raise error[0]
+    if proc.wait() != 0:
+        raise RuntimeError('ERROR!! vt normalize exited with code {0}'.format(proc.returncode))
+
+def tee(lines, path):
+    """Yields lines and writes a copy of them to a file"""
+    with open(path, 'wb') as o:
+        for line in lines:
+            o.write(line)
+            yield line
+
+def splitBlocks(blocks):
+    """Yields the lines of the blocks of marker lines from callMarkers"""
+    for block in blocks:
+        for line in block.splitlines(True):
+            yield line
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        usage()
+        sys.exit(1)
+
+    # Command line args
+    args = get_args()
+
+    # Chain the stages
+    lines = sys.stdin if args.ifil == '-' else open(args.ifil, 'rU')
+    lines = biallelic(lines, args.min_qual)
+    if args.biallelic_vcf: lines = tee(lines, args.biallelic_vcf)
+    if args.reference: lines = normalize(lines, args.vt, args.reference)
+    lines = splitBlocks(FreebayesToMarkers.callMarkers(lines))
+    if args.raw_markers: lines = tee(lines, args.raw_markers)
+
+    # Run them
+    with markermatrix.open_output(args.ofil) as o:
+        for line in FilterMarkers.filterMarkers(lines):
+            o.write(line)
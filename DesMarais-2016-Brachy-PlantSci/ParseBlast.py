@@ -6,6 +6,10 @@ Center for Research Informatics
 University of Chicago
 """
 import sys
+import argparse
+import multiprocessing
+from cStringIO import StringIO
+import blasttab
 
 def usage():
     """Prints usage to the screen"""
@@ -20,57 +24,62 @@ Notes: This is a very simplistic script to only pull out the queries with a
 single hit.
 
 Usage:
-        ParseBlast.py <blast_output> <cui_markers.v3.0.bed>
+        ParseBlast.py [--threads N] <blast_output> [<blast_output> ...] <cui_markers.v3.0.bed>
+
+The BLAST outputs can be -outfmt 6 or 7 and plain, gzip or bz2 compressed.
+When the queries were split into shards, give every shard's output in the
+order of the query files; the bed file keeps that order. With --threads N the
+shards are parsed in N processes.
 -------------------------------------------------------------------------------
 """
 
+def get_args():
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(
+        usage='ParseBlast.py [--threads N] <blast_output> [<blast_output> ...] <bed>')
+    parser.add_argument('infil', nargs='+')
+    parser.add_argument('ofil')
+    parser.add_argument('--threads', type=int, default=1,
+        help='number of shards parsed at the same time [%(default)s]')
+    return parser.parse_args()
+
 def process_hit(q, d, o):
     '''
     Processes the current hit and writes to bed file
     '''
     if len(d) == 1:
         hit = d[0]
-        row = [hit[1], str(min(int(hit[8]), int(hit[9]))), str(max(int(hit[8]), int(hit[9]))), q]
+        row = [hit.subject, str(hit.smin), str(hit.smax), q]
         o.write('\t'.join(row) + '\n')
 
+def process_shard(infil):
+    '''
+    Processes one BLAST output file, plain or compressed, and returns its
+    bed lines
+    '''
+    out = StringIO()
+    for query, data in blasttab.groups(blasttab.lines(infil)):
+        process_hit(query, data, out)
+    return out.getvalue()
+
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
+    if len(sys.argv) < 3:
         usage()
         exit(1)
 
     # Parse command line
-    infil = sys.argv[1]
-    ofil  = sys.argv[2]
-
-    # Process
-    with open(ofil, 'wb') as o:
-
-        # Set up record containers
-        query = ''
-        data = []
-
-        # Process hits
-        for line in open(infil, 'rU'):
-
-            # First query 
-            if line.startswith('# Query:') and not query:
-                query = line.rstrip().split(' ')[-1]
-
-            # All other queries 
-            elif line.startswith('# Query:') and query:
-                # Process hits from the query
-                process_hit(query, data, o)
-
-                # Reset to current query
-                query = line.rstrip().split(' ')[-1]
-                data  = []
-
-            # Comment lines 
-            elif line.startswith('#'): continue
-
-            # Add the queries hit 
-            else:
-                data.append(line.rstrip().split('\t'))
-
-        # Process last query
-        process_hit(query, data, o)
+    args = get_args()
+
+    # Process the shards, keeping them in the order given
+    with open(args.ofil, 'wb') as o:
+        if args.threads > 1 and len(args.infil) > 1:
+            pool = multiprocessing.Pool(min(args.threads, len(args.infil)))
+            try:
+                for bed in pool.imap(process_shard, args.infil):
+                    o.write(bed)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for infil in args.infil:
+                o.write(process_shard(infil))
@@ -6,10 +6,21 @@ Center for Research Informatics
 University of Chicago
 """
 import sys
+import os
+from itertools import groupby
+import shutil
+import json
+import bisect
+import argparse
+import multiprocessing
+import numpy as np
+import threadedio
 
 hpoly = 0.2
 minq = 20.0
 bases = ['0', '1', '2', '3']
+batch = 50000
+checkpoint = 1000000
 
 def usage():
     """Prints usage to the screen"""
@@ -25,112 +36,569 @@ Filters: There are hard-coded filters applied in this order:
 	- Reads with missing base calls ("missing")
 	- Reads where the quality length > read length ("lengths")
 	- Reads with a mean quality score < 20.0 ("lowqual")
-	- Reads with homopolymer lengths > 0.2 * read length ("homopolymer")  
+	- Reads with a homopolymer run >= 0.2 * read length ("homopolymer")  
+
+The statistics file also holds a histogram of the longest homopolymer run of
+every read reaching the homopolymer filter ("longest_run_<length>"), which
+shows how many reads other hpoly cutoffs would remove.
 
 Usage:
-	ShortCSFilter.py <raw.fa> <raw.qual> <filtered.fq>
+	ShortCSFilter.py [options] <raw.fa> <raw.qual> <filtered.fq>
+
+Options:
+	--batch-size N  Number of reads filtered together as NumPy arrays
+	                (default 50000). Use 0 to filter one read at a time.
+	--workers N     Number of processes. The inputs are split into record
+	                aligned shards that are filtered in parallel and joined
+	                back in the original read order (default 1).
+
+Compression: The csfasta and csqual files may be gzip, bz2 or BGZF compressed.
+The fastq is written gzip, BGZF or bz2 compressed when its name ends in .gz,
+.bgz or .bz2. Compression runs on background threads. Sharding with --workers
+needs uncompressed inputs.
+
+Checkpoints: Every --checkpoint reads (default 1000000) the csfasta, csqual and
+fastq byte offsets and the running counts are appended to <filtered.fq>.ckpt.
+With --resume an interrupted run continues from its last checkpoint. The same
+file is an offset index for jumping to any read without scanning the inputs.
 -------------------------------------------------------------------------------
 """
 
-def process_files(in_fasta, in_qual, o_fq):
+def get_args():
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(
+        usage='ShortCSFilter.py [options] <raw.fa> <raw.qual> <filtered.fq>')
+    parser.add_argument('in_fasta')
+    parser.add_argument('in_qual')
+    parser.add_argument('o_fq')
+    parser.add_argument('--batch-size', type=int, default=batch,
+        help='reads per vectorized batch, 0 disables batching [%(default)s]')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of processes filtering shards of the input [%(default)s]')
+    parser.add_argument('--checkpoint', type=int, default=checkpoint,
+        help='reads between checkpoints, 0 disables them [%(default)s]')
+    parser.add_argument('--resume', action='store_true',
+        help='continue an interrupted run from its last checkpoint')
+    return parser.parse_args()
+
+def read_batch(f_fh, q_fh, size, total, stop=None):
+    """
+    Reads the next block of paired csfasta/csqual records
+    @param f_fh - open csfasta handle
+    @param q_fh - open csqual handle
+    @param size - maximum number of records to read
+    @param total - number of records read before this block
+    @param stop - identifier of the first record not to read, if any
+    @returns lists of identifiers, color sequences and quality strings
+    """
+    heads = []
+    seqs  = []
+    quals = []
+    for n in xrange(size):
+        f_head = f_fh.readline().rstrip()
+        if not f_head or f_head == stop: break
+        f_seq  = f_fh.readline().rstrip()
+        q_head = q_fh.readline().rstrip()
+        q_qual = q_fh.readline().rstrip()
+
+        # Assert the csfasta and csqual identifiers are the same
+        assert f_head == q_head, 'ERROR!! Line {0}. Indentifier mismatch:\nfasta: {1}\ncsqual: {2}'.format(
+            total + n + 1, f_head, q_head)
+
+        heads.append(f_head)
+        seqs.append(f_seq)
+        quals.append(q_qual)
+    return heads, seqs, quals
+
+def filter_read(f_head, f_seq, q_qual, cts):
+    """
+    Applies the filters to a single read
+    @param f_head - read identifier
+    @param f_seq - color sequence
+    @param q_qual - space separated quality string
+    @param cts - dictionary of filtering statistics, updated in place
+    @returns fastq formatted record, or an empty string if the read failed
+    """
+    # Get the quality array
+    q_array = map(int, q_qual.split(' '))
+
+    # Total sequence records 
+    cts['total'] += 1 
+
+    # Missing filter
+    if '.' in f_seq: 
+        cts['missing'] += 1
+        return ''
+
+    # Lengths filter 
+    if len(q_array) > len(f_seq) - 1:
+        cts['lengths'] += 1
+        return ''
+
+    # Get average quality and filter
+    mean_q   = sum(q_array) / float(len(q_array)) 
+    if mean_q < minq:
+        cts['lowqual'] += 1
+        return ''
+
+    # Trim reads to be of the same length as qual 
+    fix_seq  = f_seq[:len(q_array) + 1]
+
+    # Filter homopolymers
+    longest = max(longest_runs(fix_seq))
+    cts['runs'][longest] = cts['runs'].get(longest, 0) + 1
+    if longest >= int(len(q_array) * hpoly):
+        cts['homopolymer'] += 1
+        return ''
+
+    # Passed filters
+    cts['passed'] += 1
+
+    # Convert to fastq
+    ascii_qual = [chr(i+33) if i <=40 else 'I' for i in q_array]
+    return '@' + f_head[1:] + '\n' + fix_seq + '\n+\n' + ''.join(ascii_qual) + '\n'
+
+def longest_runs(seq):
+    """
+    Finds the longest run of each color in a single scan of the sequence
+    @param seq - color sequence
+    @returns list of run lengths ordered as bases
+    """
+    runs = dict.fromkeys(bases, 0)
+    for b, grp in groupby(seq):
+        if b in runs:
+            n = sum(1 for _ in grp)
+            if n > runs[b]: runs[b] = n
+    return [runs[b] for b in bases]
+
+def colour_runs(seqs):
+    """
+    Finds the longest run of each color in every sequence with a single
+    vectorized scan over the whole block
+    @param seqs - list of color sequences
+    @returns array of shape (len(seqs), 4) ordered as bases
+    """
+    runs = np.zeros((len(seqs), len(bases)), dtype=np.int64)
+    if not seqs: return runs
+
+    # Sequences are separated by a newline so runs never span two reads
+    arr   = np.frombuffer('\n'.join(seqs) + '\n', dtype=np.uint8)
+    rid   = np.repeat(np.arange(len(seqs)), [len(i) + 1 for i in seqs])
+    start = np.concatenate(([0], np.flatnonzero(arr[1:] != arr[:-1]) + 1))
+    rlen  = np.diff(np.append(start, len(arr)))
+    rval  = arr[start]
+    rrid  = rid[start]
+    for n, b in enumerate(bases):
+        mask = rval == ord(b)
+        np.maximum.at(runs[:, n], rrid[mask], rlen[mask])
+    return runs
+
+def filter_batch(heads, seqs, quals, cts):
+    """
+    Applies the filters to a block of reads using NumPy arrays
+    @param heads - list of read identifiers
+    @param seqs - list of color sequences
+    @param quals - list of space separated quality strings
+    @param cts - dictionary of filtering statistics, updated in place
+    @returns fastq formatted string of the reads passing all filters
+    """
+    if not heads: return ''
+    cts['total'] += len(heads)
+
+    # Quality values of the whole block in one flat array
+    q_len  = np.array([i.count(' ') + 1 for i in quals], dtype=np.int64)
+    q_flat = np.fromstring(' '.join(quals), dtype=np.int64, sep=' ')
+    if len(q_flat) != q_len.sum():
+        raise ValueError('ERROR!! Malformed csqual record near read {0}'.format(cts['total']))
+    q_start = np.concatenate(([0], np.cumsum(q_len)[:-1]))
+    s_len   = np.array([len(i) for i in seqs], dtype=np.int64)
+
+    # Missing filter
+    missing = np.array(['.' in i for i in seqs], dtype=bool)
+    cts['missing'] += int(missing.sum())
+
+    # Lengths filter
+    lengths = ~missing & (q_len > s_len - 1)
+    cts['lengths'] += int(lengths.sum())
+
+    # Get average quality and filter
+    mean_q  = np.add.reduceat(q_flat, q_start) / q_len.astype(np.float64)
+    lowqual = ~missing & ~lengths & (mean_q < minq)
+    cts['lowqual'] += int(lowqual.sum())
+
+    passed = ~(missing | lengths | lowqual)
+    keep   = np.flatnonzero(passed)
+    if not len(keep): return ''
+
+    # Trim reads to be of the same length as qual
+    fix_seqs = [seqs[i][:q_len[i] + 1] for i in keep]
+
+    # Filter homopolymers
+    longest = colour_runs(fix_seqs).max(axis=1)
+    for n, c in enumerate(np.bincount(longest)):
+        if c: cts['runs'][n] = cts['runs'].get(n, 0) + int(c)
+    hpoly_f = longest >= (q_len[keep] * hpoly).astype(np.int64)
+    cts['homopolymer'] += int(hpoly_f.sum())
+    passed[keep[hpoly_f]] = False
+    fix_seqs = [i for i, f in zip(fix_seqs, hpoly_f) if not f]
+    keep     = keep[~hpoly_f]
+
+    # Passed filters
+    cts['passed'] += len(keep)
+
+    # Phred+33 encode the kept qualities in one transform
+    k_len = q_len[keep]
+    k_end = np.cumsum(k_len)
+    ascii_qual = np.minimum(q_flat[np.repeat(passed, q_len)], 40) + 33
+    ascii_qual = ascii_qual.astype(np.uint8).tostring()
+
+    rec = []
+    for n, i in enumerate(keep):
+        rec.append('@' + heads[i][1:] + '\n' + fix_seqs[n] + '\n+\n' + \
+                   ascii_qual[k_end[n] - k_len[n]:k_end[n]] + '\n')
+    return ''.join(rec)
+
+def new_counts():
+    """Returns an empty dictionary of filtering statistics"""
+    return {'total': 0, 'lengths': 0, 'homopolymer': 0, 'lowqual': 0, 'missing': 0, 'passed': 0,
+            'runs': {}}
+
+def load_index(o_fq):
+    """
+    Loads the checkpoints written next to a fastq file. Each checkpoint holds
+    the number of reads processed, the csfasta, csqual and fastq byte offsets
+    reached and the counts so far.
+    @param o_fq - output filtered fastq file
+    @returns list of checkpoint dictionaries in file order
+    """
+    index = []
+    if not os.path.exists(o_fq + '.ckpt'): return index
+    for line in open(o_fq + '.ckpt', 'rU'):
+        try:
+            ck = json.loads(line)
+        except ValueError:
+            # Partly written last line of an interrupted run
+            break
+        ck['cts']['runs'] = dict((int(k), v) for k, v in ck['cts']['runs'].iteritems())
+        index.append(ck)
+    return index
+
+def last_checkpoint(o_fq):
+    """
+    Finds the last checkpoint whose fastq offset is fully on disk
+    @param o_fq - output filtered fastq file
+    @returns checkpoint dictionary or None
+    """
+    size = os.path.getsize(o_fq) if os.path.exists(o_fq) else 0
+    last = None
+    for ck in load_index(o_fq):
+        if ck['fastq'] <= size: last = ck
+    return last
+
+def write_checkpoint(ck, f_pos, q_pos, o, cts, done=False):
+    """
+    Appends a checkpoint once the fastq written so far is on disk
+    @param ck - open .ckpt handle
+    @param f_pos - csfasta offset after the last read processed
+    @param q_pos - csqual offset after the last read processed
+    @param o - fastq handle, or its final size once closed
+    @param cts - dictionary of filtering statistics
+    @param done - True for the entry written when the run is complete
+    """
+    if isinstance(o, (int, long)):
+        o_pos = o
+    else:
+        o.flush()
+        os.fsync(o.fileno())
+        o_pos = o.tell()
+    ck.write(json.dumps({'records': cts['total'], 'fasta': f_pos, 'qual': q_pos,
+                         'fastq': o_pos, 'cts': cts, 'done': done}) + '\n')
+    ck.flush()
+    os.fsync(ck.fileno())
+
+def seek_record(in_fasta, in_qual, o_fq, n):
+    """
+    Opens the inputs positioned at a read using the checkpoint index of an
+    earlier run, reading forward from the nearest checkpoint at or before it
+    @param in_fasta - input raw csfasta file
+    @param in_qual - input raw csqual file
+    @param o_fq - output filtered fastq file of the earlier run
+    @param n - 0-based read number
+    @returns tuple of open csfasta and csqual handles
+    """
+    index = [i for i in load_index(o_fq) if not i['done']]
+    i     = bisect.bisect_right([j['records'] for j in index], n) - 1
+    f_fh  = threadedio.open_input(in_fasta)
+    q_fh  = threadedio.open_input(in_qual)
+    start = 0
+    if i >= 0:
+        f_fh.seek(index[i]['fasta'])
+        q_fh.seek(index[i]['qual'])
+        start = index[i]['records']
+    for fh in (f_fh, q_fh):
+        for j in xrange(2 * (n - start)):
+            fh.readline()
+    return f_fh, q_fh
+
+def process_files(in_fasta, in_qual, o_fq, batch_size=batch, shard=None,
+                  every=checkpoint, resume=False):
     """
     Performs filtering, counting, and conversion
     @param in_fasta - input raw csfasta file
     @param in_qual - input raw csqual file
     @param o_fq - output filtered fastq file
+    @param batch_size - reads filtered together, 0 filters one read at a time
+    @param shard - optional (csfasta offset, csqual offset, stop identifier)
+    restricting the run to one shard from find_shards
+    @param every - reads between checkpoints, 0 disables them
+    @param resume - continue from the last checkpoint of an earlier run
+    Inputs may be gzip, bz2 or BGZF compressed, and the output is compressed
+    when its name ends in .gz, .bgz or .bz2.
     @returns dictionary of filtering statistics
     """
-    q_fh = open(in_qual, 'rU')
-    f_fh = open(in_fasta, 'rU')
-    o    = open(o_fq, 'wb')
-    cts  = {'total': 0, 'lengths': 0, 'homopolymer': 0, 'lowqual': 0, 'missing': 0, 'passed': 0} 
+    last = last_checkpoint(o_fq) if resume else None
+    if last and last['done']: return last['cts']
+    index = [i for i in load_index(o_fq) if i['records'] <= last['records']] if last else []
+
+    q_fh = threadedio.open_input(in_qual)
+    f_fh = threadedio.open_input(in_fasta)
+    cts  = new_counts()
+    size = batch_size if batch_size > 0 else batch
+    stop = None
+    mode = 'wb'
+
+    if shard:
+        f_fh.seek(shard[0])
+        q_fh.seek(shard[1])
+        stop = shard[2]
+
+    # Pick up after the last checkpoint, dropping any fastq written after it
+    if last:
+        f_fh.seek(last['fasta'])
+        q_fh.seek(last['qual'])
+        with open(o_fq, 'r+b') as fh:
+            fh.truncate(last['fastq'])
+        cts  = last['cts']
+        mode = 'ab'
+
+    o    = threadedio.open_output(o_fq, mode)
+    ck   = open(o_fq + '.ckpt', 'wb') if every > 0 else None
+    seen = 0
+    for i in index:
+        if ck: ck.write(json.dumps(i) + '\n')
 
     # Loop over both csfasta and csqual files at the same time
     try:
         while True:
-            # csfasta info
-            f_head = f_fh.readline().rstrip()
-            if not f_head: break
-            f_seq  = f_fh.readline().rstrip()
-   
-            # csqual info 
-            q_head  = q_fh.readline().rstrip()
-            q_qual  = q_fh.readline().rstrip()
-
-            # Get the quality array
-            q_array = map(int, q_qual.split(' '))
-  
-            # Total sequence records 
-            cts['total'] += 1 
-
-            # Assert the csfasta and csqual identifiers are the same
-            assert f_head == q_head, 'ERROR!! Line {0}. Indentifier mismatch:\nfasta: {1}\ncsqual: {2}'.format(
-                cts['total'], f_head, q_head)
-
-            # Missing filter
-            if '.' in f_seq: 
-                cts['missing'] += 1
-                continue
-        
-            # Lengths filter 
-            if len(q_array) > len(f_seq) - 1:
-                cts['lengths'] += 1
-                continue 
-        
-            # Get average quality and filter
-            mean_q   = sum(q_array) / float(len(q_array)) 
-            if mean_q < minq:
-                cts['lowqual'] += 1
-                continue
-
-            # Trim reads to be of the same length as qual 
-            fix_seq  = f_seq[:len(q_array) + 1]
-
-            # Filter homopolymers
-            for b in bases:
-                curr = b*int(len(q_array) * hpoly) 
-                if curr in fix_seq:
-                    cts['homopolymer'] += 1
-                    continue
-
-            # Passed filters
-            cts['passed'] += 1
-
-            # Convert to fastq and write
-            o.write('@' + f_head[1:] + '\n')
-            o.write(fix_seq + '\n')
-            o.write('+\n')
-            ascii_qual = [chr(i+33) if i <=40 else 'I' for i in q_array]
-            o.write(''.join(ascii_qual) + '\n')
+            heads, seqs, quals = read_batch(f_fh, q_fh, size, cts['total'], stop)
+            if batch_size > 0:
+                o.write(filter_batch(heads, seqs, quals, cts))
+            else:
+                for rec in zip(heads, seqs, quals):
+                    o.write(filter_read(rec[0], rec[1], rec[2], cts))
+            if len(heads) < size: break
+
+            seen += len(heads)
+            if ck and seen >= every:
+                write_checkpoint(ck, f_fh.tell(), q_fh.tell(), o, cts)
+                seen = 0
+        end = (f_fh.tell(), q_fh.tell())
     finally:
         q_fh.close()
         f_fh.close()
         o.close()
 
-    # Close handles
-    q_fh.close()
-    f_fh.close()
-    o.close()
+    if ck:
+        write_checkpoint(ck, end[0], end[1], os.path.getsize(o_fq), cts, done=True)
+        ck.close()
 
     # Return stats
     return cts
 
+def next_header(fh, offset):
+    """
+    Finds the first record header starting at or after a byte offset
+    @param fh - open csfasta or csqual handle
+    @param offset - byte offset to start looking from
+    @returns tuple of (header offset, header) or (None, None) at the end of file
+    """
+    fh.seek(offset)
+    if offset > 0:
+        fh.seek(offset - 1)
+        fh.readline()
+    while True:
+        pos  = fh.tell()
+        line = fh.readline()
+        if not line: return None, None
+        if line.startswith('>'): return pos, line.rstrip()
+
+def find_header(fh, head, estimate, size):
+    """
+    Finds the offset of a given record header near an estimated offset,
+    widening the search window until the header is found
+    @param fh - open csfasta or csqual handle
+    @param head - record header to find
+    @param estimate - estimated byte offset of the header
+    @param size - size of the file in bytes
+    @returns byte offset of the header line
+    """
+    window = 1 << 20
+    while True:
+        start = max(0, estimate - window)
+        pos, line = next_header(fh, start)
+        while pos is not None and pos <= estimate + window:
+            if line == head: return pos
+            pos, line = next_header(fh, fh.tell())
+        if start == 0 and estimate + window >= size:
+            raise ValueError('ERROR!! Identifier {0} is missing from the csqual file'.format(head))
+        window *= 4
+
+def find_shards(in_fasta, in_qual, workers):
+    """
+    Splits the paired inputs into record aligned shards. Shard boundaries are
+    placed evenly in the csfasta file and matched by identifier in the csqual
+    file.
+    @param in_fasta - input raw csfasta file
+    @param in_qual - input raw csqual file
+    @param workers - number of shards wanted
+    @returns list of (csfasta offset, csqual offset, stop identifier) tuples
+    """
+    f_size = os.path.getsize(in_fasta)
+    q_size = os.path.getsize(in_qual)
+    bounds = []
+    with open(in_fasta, 'rb') as f_fh, open(in_qual, 'rb') as q_fh:
+        for n in range(1, workers):
+            f_pos, head = next_header(f_fh, f_size * n // workers)
+            if head is None: break
+            if bounds and bounds[-1][0] >= f_pos: continue
+            q_pos = find_header(q_fh, head, f_pos * q_size // max(f_size, 1), q_size)
+            bounds.append((f_pos, q_pos, head))
+
+    shards = []
+    start  = (0, 0)
+    for b in bounds:
+        shards.append((start[0], start[1], b[2]))
+        start = (b[0], b[1])
+    shards.append((start[0], start[1], None))
+    return shards
+
+def process_shard(args):
+    """Filters a single shard in a worker process"""
+    return process_files(*args)
+
+def join_index(in_fasta, in_qual, o_fq, shard_fqs, results):
+    """
+    Writes the checkpoint index of a sharded run, shifting the read numbers,
+    fastq offsets and counts of each shard by the shards before it
+    @param in_fasta - input raw csfasta file
+    @param in_qual - input raw csqual file
+    @param o_fq - output filtered fastq file
+    @param shard_fqs - shard fastq files in read order
+    @param results - dictionary of filtering statistics of each shard
+    """
+    base = new_counts()
+    size = 0
+    with open(o_fq + '.ckpt', 'wb') as ck:
+        for fq, res in zip(shard_fqs, results):
+            for i in load_index(fq):
+                if i['done']: continue
+                i['records'] += base['total']
+                i['fastq']   += size
+                i['cts']      = merge_counts(merge_counts(new_counts(), base), i['cts'])
+                ck.write(json.dumps(i) + '\n')
+            merge_counts(base, res)
+            size += os.path.getsize(fq)
+            if os.path.exists(fq + '.ckpt'): os.remove(fq + '.ckpt')
+        ck.write(json.dumps({'records': base['total'], 'fasta': os.path.getsize(in_fasta),
+                             'qual': os.path.getsize(in_qual), 'fastq': size,
+                             'cts': base, 'done': True}) + '\n')
+
+def merge_counts(total, cts):
+    """Adds a dictionary of filtering statistics to a running total"""
+    for k in cts:
+        if isinstance(cts[k], dict):
+            merge_counts(total.setdefault(k, {}), cts[k])
+        else:
+            total[k] = total.get(k, 0) + cts[k]
+    return total
+
+def write_stats(o_stats, cts):
+    """
+    Writes the filtering statistics and the longest run histogram
+    @param o_stats - output .trim_stats file
+    @param cts - dictionary of filtering statistics
+    """
+    keys = ['total', 'lengths', 'missing', 'lowqual', 'homopolymer', 'passed']
+    with open(o_stats, 'wb') as o:
+        for k in keys:
+            o.write(k + '\t' + str(cts[k]) + '\n') 
+        for n in sorted(cts['runs']):
+            o.write('longest_run_' + str(n) + '\t' + str(cts['runs'][n]) + '\n')
+
+def process_parallel(in_fasta, in_qual, o_fq, workers, batch_size=batch,
+                     every=checkpoint, resume=False):
+    """
+    Filters record aligned shards of the inputs in a process pool and joins
+    the shard fastq files in the original read order. Each shard keeps its
+    own checkpoints, so a resumed run must use the same number of workers.
+    @param in_fasta - input raw csfasta file
+    @param in_qual - input raw csqual file
+    @param o_fq - output filtered fastq file
+    @param workers - number of worker processes
+    @param batch_size - reads filtered together, 0 filters one read at a time
+    @param every - reads between checkpoints, 0 disables them
+    @param resume - continue each shard from its last checkpoint
+    @returns dictionary of filtering statistics
+    """
+    if threadedio.sniff(in_fasta) or threadedio.sniff(in_qual):
+        raise ValueError('ERROR!! --workers needs uncompressed csfasta/csqual inputs')
+
+    last = last_checkpoint(o_fq) if resume else None
+    if last and last['done']: return last['cts']
+
+    # Shards are compressed the same way as the output so they can be joined
+    ext    = threadedio.output_extension(o_fq)
+    shards = find_shards(in_fasta, in_qual, workers)
+    tasks  = [(in_fasta, in_qual, '{0}.shard{1:03d}{2}'.format(o_fq, n, ext), batch_size, s,
+               every, resume) for n, s in enumerate(shards)]
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        results = pool.map(process_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Join the shards and add up the counts
+    cts = new_counts()
+    with open(o_fq, 'wb') as o:
+        for t, res in zip(tasks, results):
+            with open(t[2], 'rb') as fh:
+                shutil.copyfileobj(fh, o, 1 << 22)
+            merge_counts(cts, res)
+    if every > 0:
+        join_index(in_fasta, in_qual, o_fq, [t[2] for t in tasks], results)
+    for t in tasks:
+        os.remove(t[2])
+    return cts
+
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
+    if len(sys.argv) < 4:
         usage() 
         sys.exit(1)
 
     # Input files
-    in_fasta = sys.argv[1]
-    in_qual  = sys.argv[2]
-    o_fq     = sys.argv[3]
+    args     = get_args()
+    in_fasta = args.in_fasta
+    in_qual  = args.in_qual
+    o_fq     = args.o_fq
 
     # Filter, write fastq, and get stats
-    cmap = process_files(in_fasta, in_qual, o_fq)
+    if args.workers > 1:
+        cmap = process_parallel(in_fasta, in_qual, o_fq, args.workers, args.batch_size,
+                                args.checkpoint, args.resume)
+    else:
+        cmap = process_files(in_fasta, in_qual, o_fq, args.batch_size, None,
+                             args.checkpoint, args.resume)
 
     # Write stats
-    o_stats  = o_fq + '.trim_stats'
-    keys = ['total', 'lengths', 'missing', 'lowqual', 'homopolymer', 'passed']
-    with open(o_stats, 'wb') as o:
-        for k in keys:
-            o.write(k + '\t' + str(cmap[k]) + '\n') 
+    write_stats(o_fq + '.trim_stats', cmap)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Kyle Hernandez
+khernandez@bsd.uchicago.edu
+Center for Research Informatics
+University of Chicago
+
+Typed records for BLAST tabular output (-outfmt 6 and 7) and for the best hit
+files made from it, which share the same 12 leading columns. Lines are read a
+chunk at a time and every hit becomes a compact tuple record with typed
+columns that keeps its original line for lossless output.
+
+Lowry-2013-FxH-Map/python/SyntenyScripts has a copy with the same functions;
+each project stands alone, so changes go to both.
+"""
+from collections import namedtuple
+from itertools import islice, groupby, chain
+from operator import attrgetter
+import threadedio
+
+chunk  = 50000
+fields = ('query', 'subject', 'pident', 'length', 'mismatch', 'gapopen',
+          'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore')
+
+class Hit(namedtuple('Hit', fields + ('line',))):
+    """
+    A single BLAST hit with typed columns. 'line' is the original line
+    without its newline.
+    """
+    __slots__ = ()
+
+    @property
+    def smin(self):
+        """Leftmost subject position"""
+        return min(self.sstart, self.send)
+
+    @property
+    def smax(self):
+        """Rightmost subject position"""
+        return max(self.sstart, self.send)
+
+    def columns(self):
+        """Returns the original text columns"""
+        return self.line.split('\t')
+
+# Builds a Hit from a ready tuple without going through the keyword signature
+_new = tuple.__new__
+
+def convert(lines):
+    """Converts a list of hit lines (without newlines) into Hit records"""
+    hits = []
+    for line in lines:
+        c = line.split('\t', 12)
+        if len(c) < 12:
+            raise ValueError('ERROR!! BLAST hits need at least 12 columns:\n{0}'.format(line))
+        hits.append(_new(Hit, (c[0], c[1], float(c[2]), int(c[3]), int(c[4]),
+                               int(c[5]), int(c[6]), int(c[7]), int(c[8]),
+                               int(c[9]), float(c[10]), float(c[11]), line)))
+    return hits
+
+def parse(lines, size=chunk):
+    """Yields the Hit records of BLAST tabular lines, skipping comments"""
+    lines = iter(lines)
+    block = list(islice(lines, size))
+    while block:
+        keep = [i.rstrip('\r\n') for i in block if not i.startswith('#') and i.strip()]
+        for hit in convert(keep):
+            yield hit
+        block = list(islice(lines, size))
+
+def lines(path):
+    """Yields the lines of a plain or compressed file and closes it at the end"""
+    with threadedio.open_input(path) as fh:
+        for line in fh:
+            yield line
+
+def by_query(hits):
+    """Yields (query, list of hits) for runs of consecutive hits of a query"""
+    for query, grp in groupby(hits, attrgetter('query')):
+        yield query, list(grp)
+
+def groups(lines):
+    """
+    Yields the (query, hits) groups of BLAST tabular output. Works for
+    -outfmt 7, where queries come from the '# Query:' comments and can have
+    no hits, and for -outfmt 6, where consecutive hits of a query are grouped.
+    """
+    lines   = iter(lines)
+    query   = ''
+    data    = []
+    rows    = []
+    comment = False
+    started = False
+    for line in lines:
+        if line.startswith('# Query:'):
+            if started: yield query, data + convert(rows)
+            query   = line.rstrip().split(' ')[-1]
+            data    = []
+            rows    = []
+            comment = True
+            started = True
+        elif line.startswith('#') or not line.strip(): continue
+        elif comment:
+            rows.append(line.rstrip('\r\n'))
+            if len(rows) >= chunk:
+                data += convert(rows)
+                rows  = []
+        else:
+            # -outfmt 6, no query comments
+            for q, hits in by_query(parse(chain([line], lines))):
+                yield q, hits
+            return
+    if started: yield query, data + convert(rows)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+Kyle Hernandez
+khernandez@bsd.uchicago.edu
+Center for Research Informatics
+University of Chicago
+
+Reader and writer for binary marker matrices (.mkb). Genotypes are packed at
+2 bits per call (0 missing, 1 A, 2 B, 3 H), four samples per byte, with one
+fixed-width row per marker, so the matrix can be memory-mapped and a reader
+can unpack only the markers and samples it needs.
+
+Layout:
+    'MKB\\x01'                       magic
+    <Q n_markers> <Q table_offset>  little-endian
+    <I header_size> header          JSON: samples, columns, missing, row_bytes
+    genotype rows                   n_markers x row_bytes, at a 16 byte offset
+    marker table                    tab-delimited text to the end of the file:
+                                    id, scaffold, position, site stats
+
+The first entry of 'columns' is the name of the marker id column and the rest
+are the site statistics that sit between the id and the calls in the text
+matrix (none for FreebayesToMarkers.py, seven for vcf_to_marker.py).
+
+Lowry-2013-FxH-Map/python/GenotypeScripts has a copy for vcf_to_marker.py and
+marker_to_qtl_format.py; each project stands alone, so changes go to both.
+"""
+import sys
+import json
+import struct
+import tempfile
+import shutil
+from itertools import islice
+import numpy as np
+
+magic  = 'MKB\x01'
+prefix = struct.Struct('<4sQQI')
+chunk  = 100000
+calls  = 'ABH'
+
+def usage():
+    """Prints usage to the screen"""
+    print """
+-------------------------------------------------------------------------------
+Author: Kyle Hernandez <khernandez@bsd.uchicago.edu>
+
+Description: Converts marker matrices between tab-delimited text and the
+2-bit binary .mkb format.
+
+Usage:
+	markermatrix.py to-mkb <markers.txt> <markers.mkb> [n_stats]
+	markermatrix.py to-tsv <markers.mkb> <markers.txt>
+
+	n_stats - number of site statistics columns between the marker id and the
+	          calls (0 for FreebayesToMarkers.py, 7 for vcf_to_marker.py)
+-------------------------------------------------------------------------------
+"""
+
+def is_binary(path):
+    """Checks an existing file for the .mkb magic bytes"""
+    with open(path, 'rb') as fh:
+        return fh.read(len(magic)) == magic
+
+def open_input(path):
+    """
+    Opens a text or binary marker matrix for reading
+    @returns an iterable of tab-delimited marker lines, starting with the header
+    """
+    if is_binary(path): return MarkerMatrix(path)
+    return open(path, 'rU')
+
+def open_output(path, n_stats=0):
+    """
+    Opens a marker matrix for writing; .mkb files are written in binary and
+    everything else as text
+    @param n_stats - number of site statistics columns after the marker id
+    @returns a file-like object that takes tab-delimited marker lines
+    """
+    if path.endswith('.mkb'): return MarkerWriter(path, n_stats)
+    return open(path, 'wb')
+
+def split_id(marker):
+    """Splits a 'scaffold:position' marker id, position is -1 if missing"""
+    scf, _, pos = marker.rpartition(':')
+    try:
+        return scf, int(pos)
+    except ValueError:
+        return marker, -1
+
+def pack(codes):
+    """Packs a markers x samples array of 2-bit codes into rows of bytes"""
+    n, s  = codes.shape
+    width = (s + 3) // 4
+    full  = np.zeros((n, width * 4), dtype=np.uint8)
+    full[:, :s] = codes
+    full = full.reshape(n, width, 4)
+    return full[:, :, 0] | (full[:, :, 1] << 2) | (full[:, :, 2] << 4) | (full[:, :, 3] << 6)
+
+def unpack(rows, n_samples, samples=None):
+    """
+    Unpacks rows of bytes into a markers x samples array of 2-bit codes
+    @param samples - optional sample indices, only their bytes are read
+    """
+    if samples is not None:
+        idx = np.asarray(samples, dtype=np.intp)
+        return (rows[:, idx >> 2] >> ((idx & 3) << 1).astype(np.uint8)) & 3
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+    return ((rows[:, :, None] >> shifts) & 3).reshape(rows.shape[0], -1)[:, :n_samples]
+
+def table_row(marker, stats=()):
+    """Returns the marker table line of a marker id and its site stats"""
+    scf, pos = split_id(marker)
+    return '\t'.join([marker, scf, str(pos)] + list(stats)) + '\n'
+
+def parse_row(row):
+    """Parses a marker table line into an (id, scaffold, position, stats) tuple"""
+    cols = row.rstrip('\n').split('\t')
+    return (cols[0], cols[1], int(cols[2]), cols[3:])
+
+def format_lines(table, codes, missing):
+    """
+    Formats marker table lines and their codes as tab-delimited marker lines
+    @param table - list of marker table lines
+    @param codes - markers x samples array of 2-bit codes
+    @param missing - character used for missing calls
+    """
+    if not table: return ''
+    table = [parse_row(i) for i in table]
+    lut = np.array([ord(i) for i in missing + calls], dtype=np.uint8)
+    out = np.empty((codes.shape[0], 2 * codes.shape[1]), dtype=np.uint8)
+    out[:, 0::2] = lut[codes]
+    out[:, 1::2] = ord('\t')
+    out[:, -1]   = ord('\n')
+    return ''.join('\t'.join([t[0]] + t[3]) + '\t' + r.tostring() for t, r in zip(table, out))
+
+class MarkerMatrix(object):
+    """
+    Memory-mapped reader for a .mkb marker matrix. Iterating over it yields
+    the same tab-delimited lines as the text matrix.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            tag, self.n, self.table_offset, size = prefix.unpack(fh.read(prefix.size))
+            if tag != magic:
+                raise ValueError('ERROR!! {0} is not a .mkb marker matrix'.format(path))
+            head = json.loads(fh.read(size))
+        self.samples   = [str(i) for i in head['samples']]
+        self.columns   = [str(i) for i in head['columns']]
+        self.missing   = str(head['missing'])
+        self.row_bytes = head['row_bytes']
+        self.offset    = head['offset']
+        if self.n and self.row_bytes:
+            self.rows = np.memmap(path, dtype=np.uint8, mode='r', offset=self.offset,
+                                  shape=(self.n, self.row_bytes))
+        else:
+            self.rows = np.zeros((self.n, self.row_bytes), dtype=np.uint8)
+
+    def __len__(self):
+        return self.n
+
+    def header(self):
+        """Returns the header line of the text matrix"""
+        return '\t'.join(self.columns + self.samples) + '\n'
+
+    def codes(self, start=0, stop=None, samples=None):
+        """
+        Returns the 2-bit codes of a range of markers
+        @param samples - optional sample indices to unpack
+        """
+        return unpack(np.asarray(self.rows[start:stop]), len(self.samples), samples)
+
+    def table(self):
+        """Yields the (id, scaffold, position, stats) tuple of every marker"""
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.table_offset)
+            for line in fh:
+                yield parse_row(line)
+
+    def chunks(self, size=chunk, samples=None):
+        """
+        Yields (marker table lines, codes) for consecutive blocks of markers.
+        The table lines are left unparsed; see parse_row.
+        """
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.table_offset)
+            for start in xrange(0, self.n, size):
+                rows = list(islice(fh, size))
+                yield rows, self.codes(start, start + len(rows), samples)
+
+    def __iter__(self):
+        yield self.header()
+        for rows, codes in self.chunks():
+            for line in format_lines(rows, codes, self.missing).splitlines(True):
+                yield line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.rows = None
+
+class MarkerWriter(object):
+    """
+    File-like writer for a .mkb marker matrix. It takes the tab-delimited
+    lines of the text matrix, starting with the header, and packs them in
+    chunks. Calls must be single characters: A, B, H or the missing call.
+    """
+    def __init__(self, path, n_stats=0):
+        self.path    = path
+        self.n_stats = n_stats
+        self.fh      = open(path, 'wb')
+        self.spool   = tempfile.TemporaryFile()
+        self.parts   = []
+        self.size    = 0
+        self.rest    = ''
+        self.n       = 0
+        self.samples = None
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= 1 << 24: self._flush()
+
+    def _flush(self):
+        data = self.rest + ''.join(self.parts)
+        self.parts = []
+        self.size  = 0
+        end = data.rfind('\n') + 1
+        self.rest = data[end:]
+        lines = data[:end].splitlines()
+        if lines and self.samples is None:
+            cols = lines.pop(0).split('\t')
+            self.start(cols[self.n_stats + 1:], cols[:self.n_stats + 1])
+        if lines: self._parse(lines)
+
+    def start(self, samples, columns, missing=None):
+        """Sets the samples, the id/stats columns and the missing call"""
+        self.samples   = samples
+        self.columns   = columns
+        self.missing   = missing
+        self.row_bytes = (len(samples) + 3) // 4
+
+    def _header(self):
+        head = {'samples': self.samples, 'columns': self.columns,
+                'missing': self.missing or 'N', 'row_bytes': self.row_bytes, 'offset': 0}
+        size = len(json.dumps(head)) + 8
+        head['offset'] = (prefix.size + size + 15) // 16 * 16
+        return json.dumps(head).ljust(size), head['offset']
+
+    def _parse(self, lines):
+        """Packs a chunk of text marker lines"""
+        n_lead = self.n_stats + 1
+        table, width = [], 2 * len(self.samples) - 1
+        body = []
+        for line in lines:
+            cols = line.split('\t', n_lead)
+            if len(cols) <= n_lead or len(cols[-1]) != width:
+                raise ValueError('ERROR!! Marker line does not match the header:\n{0}'.format(line))
+            table.append(table_row(cols[0], cols[1:n_lead]))
+            body.append(cols[-1])
+        mat = np.frombuffer(''.join(body), dtype=np.uint8).reshape(len(body), width)
+        if not (mat[:, 1::2] == ord('\t')).all():
+            raise ValueError('ERROR!! Marker calls must be single characters')
+        mat = mat[:, 0::2]
+
+        # The missing call is whatever is not A, B or H
+        other = np.setdiff1d(np.unique(mat), [ord(i) for i in calls])
+        if self.missing is None and other.size:
+            self.missing = chr(other[0])
+        if other.size > 1 or (other.size and chr(other[0]) != self.missing):
+            raise ValueError('ERROR!! Found more than one kind of missing call')
+
+        lut = np.zeros(256, dtype=np.uint8)
+        for n, c in enumerate(calls): lut[ord(c)] = n + 1
+        self.write_codes(table, lut[mat])
+
+    def write_codes(self, table, codes):
+        """
+        Writes markers that are already coded
+        @param table - list of marker table lines (see table_row)
+        @param codes - markers x samples array of 2-bit codes
+        """
+        if not table: return
+        if self.n == 0:
+            # The header is written on close, once the missing call is known
+            self.fh.seek(self._header()[1])
+        self.fh.write(pack(np.asarray(codes, dtype=np.uint8)).tostring())
+        self.spool.write(''.join(table))
+        self.n += len(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fh.closed: return
+        try:
+            self._flush()
+            if self.rest:
+                self._parse([self.rest])
+                self.rest = ''
+            if self.samples is None:
+                raise ValueError('ERROR!! No header was written to {0}'.format(self.path))
+            head, offset = self._header()
+            table_offset = offset + self.n * self.row_bytes
+            self.fh.seek(table_offset)
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, self.fh, 1 << 22)
+            self.fh.seek(0)
+            self.fh.write(prefix.pack(magic, self.n, table_offset, len(head)) + head)
+        finally:
+            self.spool.close()
+            self.fh.close()
+
+def convert(ifil, ofil, n_stats=0):
+    """Copies a marker matrix between the text and binary formats"""
+    fh = open_input(ifil)
+    with open_output(ofil, n_stats) as o:
+        if isinstance(fh, MarkerMatrix) and isinstance(o, MarkerWriter):
+            o.start(fh.samples, fh.columns, fh.missing)
+            for rows, codes in fh.chunks():
+                o.write_codes(rows, codes)
+        else:
+            for line in fh:
+                o.write(line)
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5) or sys.argv[1] not in ('to-mkb', 'to-tsv'):
+        usage()
+        sys.exit(1)
+
+    if sys.argv[1] == 'to-mkb':
+        if not sys.argv[3].endswith('.mkb'):
+            print >> sys.stderr, 'ERROR!! Binary marker matrices must end with .mkb'
+            sys.exit(1)
+        convert(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) == 5 else 0)
+    else:
+        convert(sys.argv[2], sys.argv[3])
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Kyle Hernandez
+khernandez@bsd.uchicago.edu
+Center for Research Informatics
+University of Chicago
+
+Mergeable quantile sketch for non-negative values such as variant QUALs.
+Values are counted in logarithmic buckets (as in DDSketch), so every quantile
+is returned within a relative error of 'alpha' of the exact value, memory only
+grows with the log of the range of the values, and the sketches of separate
+shards merge by adding their bucket counts.
+"""
+import math
+from itertools import islice
+import numpy as np
+
+accuracy = 0.001
+chunk    = 100000
+
+class QuantileSketch(object):
+    """
+    Log-bucket quantile sketch. Bucket i holds the values in
+    (gamma^(i-1), gamma^i] with gamma = (1 + alpha) / (1 - alpha); zeros
+    are counted on their own.
+    """
+    def __init__(self, alpha=accuracy):
+        self.alpha   = alpha
+        self.gamma   = (1.0 + alpha) / (1.0 - alpha)
+        self.log_g   = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros   = 0
+        self.count   = 0
+
+    def add(self, values):
+        """Adds an array of values"""
+        values = np.asarray(values, dtype=float)
+        if not values.size: return
+        if (values < 0).any():
+            raise ValueError('ERROR!! The quantile sketch only takes values >= 0')
+        pos  = values[values > 0]
+        self.zeros += values.size - pos.size
+        self.count += values.size
+        idx, cts = np.unique(np.ceil(np.log(pos) / self.log_g).astype(np.int64),
+                             return_counts=True)
+        for i, c in zip(idx.tolist(), cts.tolist()):
+            self.buckets[i] = self.buckets.get(i, 0) + c
+
+    def update(self, values):
+        """Adds the values of an iterable, a chunk at a time"""
+        values = iter(values)
+        block  = list(islice(values, chunk))
+        while block:
+            self.add(block)
+            block = list(islice(values, chunk))
+
+    def merge(self, other):
+        """Adds the counts of a sketch with the same accuracy"""
+        if other.alpha != self.alpha:
+            raise ValueError('ERROR!! Cannot merge sketches with different accuracies')
+        for i, c in other.buckets.iteritems():
+            self.buckets[i] = self.buckets.get(i, 0) + c
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """
+        Returns the q quantile (0 <= q <= 1), using the same rank as
+        scipy.stats.scoreatpercentile, or nan when the sketch is empty
+        """
+        if not self.count: return float('nan')
+        rank = q * (self.count - 1)
+        if rank < self.zeros: return 0.0
+        seen = self.zeros
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if rank < seen:
+                return 2.0 * self.gamma ** i / (self.gamma + 1.0)
+        return 2.0 * self.gamma ** max(self.buckets) / (self.gamma + 1.0)
+
+    def save(self, path):
+        """Writes the sketch as a small text file"""
+        with open(path, 'wb') as o:
+            o.write('#qsketch\t{0!r}\t{1}\t{2}\n'.format(self.alpha, self.count, self.zeros))
+            for i in sorted(self.buckets):
+                o.write('{0}\t{1}\n'.format(i, self.buckets[i]))
+
+def load(path):
+    """Reads a sketch written by QuantileSketch.save"""
+    with open(path, 'rU') as fh:
+        head = fh.readline().rstrip().split('\t')
+        if head[0] != '#qsketch':
+            raise ValueError('ERROR!! {0} is not a quantile sketch'.format(path))
+        sk = QuantileSketch(float(head[1]))
+        sk.count = int(head[2])
+        sk.zeros = int(head[3])
+        for line in fh:
+            i, c = line.split('\t')
+            sk.buckets[int(i)] = int(c)
+    return sk
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Kyle Hernandez
+khernandez@bsd.uchicago.edu
+Center for Research Informatics
+University of Chicago
+
+Readers and writers for plain, gzip, bz2 and BGZF files. Compressed files are
+decompressed or compressed on a background thread that is connected to the
+caller by a bounded queue, so codec time overlaps with the caller's work.
+"""
+import bz2
+import zlib
+import struct
+import threading
+import Queue
+
+chunk_size  = 1 << 20
+queue_depth = 8
+
+# BGZF blocks hold at most 64 KB; leave room for incompressible data
+bgzf_block  = 0xff00
+bgzf_eof    = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+               '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+extensions  = {'.gz': 'gzip', '.bz2': 'bz2', '.bgz': 'bgzf', '.bgzf': 'bgzf'}
+
+def sniff(path):
+    """
+    Detects the compression of an existing file from its magic bytes
+    @param path - file to check
+    @returns 'gzip', 'bgzf', 'bz2' or None for plain files
+    """
+    with open(path, 'rb') as fh:
+        magic = fh.read(16)
+    if magic.startswith('\x1f\x8b'):
+        if len(magic) >= 14 and ord(magic[3]) & 4 and magic[12:14] == 'BC':
+            return 'bgzf'
+        return 'gzip'
+    elif magic.startswith('BZh'):
+        return 'bz2'
+    return None
+
+def output_format(path):
+    """Returns the compression used for an output file from its extension"""
+    for ext in extensions:
+        if path.endswith(ext): return extensions[ext]
+    return None
+
+def output_extension(path):
+    """Returns the compression extension of an output file, if any"""
+    for ext in extensions:
+        if path.endswith(ext): return ext
+    return ''
+
+def open_input(path):
+    """
+    Opens a plain or compressed file for reading
+    @param path - input file
+    @returns a file-like object with readline, read, tell and forward seek
+    """
+    fmt = sniff(path)
+    if fmt is None: return open(path, 'rU')
+    return ThreadedReader(path, fmt)
+
+def open_output(path, mode='wb', fmt=None):
+    """
+    Opens a plain or compressed file for writing. The compression is taken
+    from the file extension unless given.
+    @param path - output file
+    @param mode - 'wb' to create or 'ab' to append
+    @param fmt - optional 'gzip', 'bgzf' or 'bz2'
+    @returns a file-like object with write, flush, tell and close
+    """
+    fmt = fmt or output_format(path)
+    if fmt is None: return open(path, mode)
+    return ThreadedWriter(path, fmt, mode)
+
+def decompressor(fmt):
+    """Returns a new decompressor for a single gzip member or bz2 stream"""
+    if fmt == 'bz2': return bz2.BZ2Decompressor()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def compress(fmt, data, level=6):
+    """
+    Compresses a block of data into one or more self-contained gzip members,
+    BGZF blocks or bz2 streams, so blocks can be concatenated
+    """
+    if fmt == 'bz2':
+        return bz2.compress(data, 9)
+    elif fmt == 'gzip':
+        c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+    blocks = []
+    for i in xrange(0, len(data), bgzf_block):
+        blocks.append(bgzf_compress(data[i:i + bgzf_block], level))
+    return ''.join(blocks)
+
+def bgzf_compress(data, level=6):
+    """Compresses up to 64 KB of data into a single BGZF block"""
+    c     = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = c.compress(data) + c.flush()
+    head  = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                        ord('B'), ord('C'), 2, len(cdata) + 25)
+    tail  = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return head + cdata + tail
+
+class ThreadedReader(object):
+    """
+    File-like reader for a compressed file. A background thread reads and
+    decompresses chunks into a bounded queue; concatenated gzip members,
+    BGZF blocks and bz2 streams are all followed.
+    """
+    def __init__(self, path, fmt):
+        self.path   = path
+        self.fmt    = fmt
+        self.queue  = Queue.Queue(queue_depth)
+        self.buffer = ''
+        self.offset = 0
+        self.pos    = 0
+        self.eof    = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                dec = decompressor(self.fmt)
+                while not self.closed:
+                    raw = fh.read(chunk_size)
+                    if not raw: break
+                    while raw:
+                        try:
+                            data = dec.decompress(raw)
+                        except EOFError:
+                            # Finished bz2 stream followed by another
+                            dec = decompressor(self.fmt)
+                            continue
+                        if data: self.queue.put(data)
+                        raw = dec.unused_data
+                        if raw:
+                            if not raw.strip('\x00'): break
+                            dec = decompressor(self.fmt)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def _fill(self):
+        """Moves the next decompressed chunk into the buffer"""
+        if self.eof: return False
+        data = self.queue.get()
+        if data is None:
+            self.eof = True
+            return False
+        elif isinstance(data, Exception):
+            self.eof = True
+            raise data
+        self.buffer = self.buffer[self.offset:] + data
+        self.offset = 0
+        return True
+
+    def readline(self):
+        while True:
+            i = self.buffer.find('\n', self.offset)
+            if i >= 0 or not self._fill():
+                end  = i + 1 if i >= 0 else len(self.buffer)
+                line = self.buffer[self.offset:end]
+                self.offset = end
+                self.pos   += len(line)
+                return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            if not self._fill(): break
+        end  = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+        data = self.buffer[self.offset:end]
+        self.offset = end
+        self.pos   += len(data)
+        return data
+
+    def tell(self):
+        """Returns the offset in the decompressed data"""
+        return self.pos
+
+    def seek(self, offset):
+        """Seeks forward to an offset in the decompressed data"""
+        if offset < self.pos:
+            raise IOError('Compressed input {0} can only seek forward'.format(self.path))
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, chunk_size)): break
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        while self.thread.is_alive():
+            try: self.queue.get(timeout=0.1)
+            except Queue.Empty: pass
+
+class ThreadedWriter(object):
+    """
+    File-like writer for a compressed file. Writes are gathered into chunks
+    that a background thread compresses and appends to the file. Every chunk
+    is compressed on its own, so after flush() the file ends on a member
+    boundary and tell() is a valid offset to truncate to.
+    """
+    def __init__(self, path, fmt, mode='wb'):
+        self.path   = path
+        self.fmt    = fmt
+        self.fh     = open(path, mode)
+        self.queue  = Queue.Queue(queue_depth)
+        self.parts  = []
+        self.size   = 0
+        self.error  = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None: break
+                if self.error is None:
+                    self.fh.write(compress(self.fmt, data))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None: raise self.error
+
+    def _put(self):
+        if self.parts:
+            self.queue.put(''.join(self.parts))
+            self.parts = []
+            self.size  = 0
+        self._check()
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= chunk_size: self._put()
+
+    def flush(self):
+        """Waits until everything written so far is compressed and on disk"""
+        self._put()
+        self.queue.join()
+        self._check()
+        self.fh.flush()
+
+    def tell(self):
+        """Returns the compressed size of the file after a flush"""
+        self.flush()
+        return self.fh.tell()
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fh.closed: return
+        try:
+            self._put()
+            self.queue.put(None)
+            self.thread.join()
+            self._check()
+            if self.fmt == 'bgzf': self.fh.write(bgzf_eof)
+        finally:
+            self.fh.close()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Kyle Hernandez
+khernandez@bsd.uchicago.edu
+Center for Research Informatics
+University of Chicago
+
+Region index and parallel region processing for plain-text VCF files. The
+index is a tabix-style linear index saved next to the VCF as <file.vcf>.ridx.
+It holds the byte offset and first position of every block of records on each
+contig, so a region is read by seeking straight to its first block.
+"""
+import os
+import bisect
+import shutil
+import multiprocessing
+import threadedio
+
+step = 4096
+
+def build_index(vcf):
+    """
+    Scans a VCF once and records the offset of every block of records
+    @param vcf - plain-text VCF sorted by contig and position
+    @returns index dictionary
+    """
+    index = {'size': os.path.getsize(vcf), 'header_end': 0, 'contigs': [], 'blocks': {}}
+    contig = None
+    last = 0
+    pos = 0
+    n = 0
+    with open(vcf, 'rb') as fh:
+        for line in fh:
+            if line.startswith('#'):
+                pos += len(line)
+                index['header_end'] = pos
+                continue
+            tab = line.find('\t')
+            c   = line[:tab]
+            p   = int(line[tab + 1:line.find('\t', tab + 1)])
+            if c != contig:
+                if c in index['blocks']:
+                    raise ValueError('ERROR!! {0} is not grouped by contig ({1})'.format(vcf, c))
+                index['contigs'].append(c)
+                index['blocks'][c] = []
+                contig = c
+                n = 0
+            elif p < last:
+                raise ValueError('ERROR!! {0} is not sorted by position ({1}:{2})'.format(vcf, c, p))
+            if n % step == 0:
+                index['blocks'][c].append((p, pos))
+            last = p
+            n   += 1
+            pos += len(line)
+    return index
+
+def write_index(vcf, index):
+    """Writes the index next to the VCF"""
+    with open(vcf + '.ridx', 'wb') as o:
+        o.write('##size\t{0}\n##header_end\t{1}\n'.format(index['size'], index['header_end']))
+        for c in index['contigs']:
+            for b in index['blocks'][c]:
+                o.write('{0}\t{1}\t{2}\n'.format(c, b[0], b[1]))
+
+def load_index(vcf):
+    """
+    Loads the index of a VCF, building and saving it first if it is missing
+    or older than the VCF
+    @param vcf - plain-text VCF sorted by contig and position
+    @returns index dictionary
+    """
+    if threadedio.sniff(vcf):
+        raise ValueError('ERROR!! Region processing needs an uncompressed VCF: {0}'.format(vcf))
+
+    ridx = vcf + '.ridx'
+    if os.path.exists(ridx) and os.path.getmtime(ridx) >= os.path.getmtime(vcf):
+        index = {'size': None, 'header_end': 0, 'contigs': [], 'blocks': {}}
+        for line in open(ridx, 'rU'):
+            cols = line.rstrip().split('\t')
+            if line.startswith('##'):
+                index[cols[0][2:]] = int(cols[1])
+            else:
+                if cols[0] not in index['blocks']:
+                    index['contigs'].append(cols[0])
+                    index['blocks'][cols[0]] = []
+                index['blocks'][cols[0]].append((int(cols[1]), int(cols[2])))
+        if index['size'] == os.path.getsize(vcf):
+            return index
+
+    index = build_index(vcf)
+    try:
+        write_index(vcf, index)
+    except IOError:
+        pass
+    return index
+
+def read_regions(arg):
+    """
+    Reads a region list, given either as a file with one region per line or
+    as a comma-separated string. Regions are 'contig' or 'contig:start-end'.
+    """
+    if os.path.isfile(arg):
+        return [i.strip() for i in open(arg, 'rU') if i.strip() and not i.startswith('#')]
+    return [i for i in arg.split(',') if i]
+
+def parse_region(index, region):
+    """
+    Parses a region string into a (contig, start, end) tuple with 1-based,
+    inclusive positions; start and end are None for whole contigs
+    """
+    if region in index['blocks']:
+        return (region, None, None)
+    contig, _, span = region.rpartition(':')
+    if contig not in index['blocks']:
+        raise ValueError('ERROR!! Region {0} is not in the VCF'.format(region))
+    start, _, end = span.partition('-')
+    return (contig, int(start.replace(',', '')), int(end.replace(',', '')) if end else None)
+
+def sorted_regions(index, regions=None):
+    """
+    Returns parsed regions in genomic order, every contig when none are given.
+    Overlapping regions of a contig are merged, so no record is written twice.
+    """
+    if not regions:
+        return [(c, None, None) for c in index['contigs']]
+    order = dict((c, n) for n, c in enumerate(index['contigs']))
+    merged = []
+    for r in sorted([parse_region(index, r) for r in regions],
+                    key=lambda r: (order[r[0]], r[1] or 0)):
+        if merged and merged[-1][0] == r[0]:
+            contig, start, end = merged[-1]
+            if end is None or (r[1] or 0) <= end:
+                merged[-1] = (contig, start, None if end is None or r[2] is None else max(end, r[2]))
+                continue
+        merged.append(r)
+    return merged
+
+def region_offsets(index, region):
+    """Returns the byte range of the blocks that can hold a region"""
+    contig, start, end = region
+    blocks = index['blocks'][contig]
+    n = index['contigs'].index(contig)
+    stop = index['blocks'][index['contigs'][n + 1]][0][1] \
+           if n + 1 < len(index['contigs']) else index['size']
+    pos = [b[0] for b in blocks]
+    first = 0 if start is None else max(0, bisect.bisect_left(pos, start) - 1)
+    if end is not None:
+        last = bisect.bisect_right(pos, end)
+        if last < len(blocks): stop = blocks[last][1]
+    return blocks[first][1], stop
+
+def read_header(vcf, index):
+    """Returns the header lines of an indexed VCF"""
+    with open(vcf, 'rb') as fh:
+        return fh.read(index['header_end']).splitlines(True)
+
+def fetch(vcf, index, region):
+    """
+    Yields the record lines of a region
+    @param vcf - plain-text VCF
+    @param index - index from load_index
+    @param region - (contig, start, end) tuple from sorted_regions
+    """
+    for pos, line in fetch_records(vcf, index, region):
+        yield line
+
+def fetch_records(vcf, index, region):
+    """Yields the (byte offset, line) of every record of a region"""
+    contig, start, end = region
+    first, stop = region_offsets(index, region)
+    with open(vcf, 'rb') as fh:
+        fh.seek(first)
+        pos = first
+        while pos < stop:
+            line = fh.readline()
+            if not line: break
+            at   = pos
+            pos += len(line)
+            if start is not None or end is not None:
+                cols = line.split('\t', 2)
+                if cols[0] != contig: continue
+                p = int(cols[1])
+                if start is not None and p < start: continue
+                if end is not None and p > end: break
+            yield at, line
+
+def map_regions(func, tasks, threads):
+    """
+    Runs a function over per-region tasks in a process pool and yields the
+    results in task order
+    """
+    if threads <= 1 or len(tasks) <= 1:
+        for t in tasks:
+            yield func(t)
+        return
+    pool = multiprocessing.Pool(min(threads, len(tasks)))
+    try:
+        for res in pool.imap(func, tasks):
+            yield res
+    except:
+        # Stop the workers on an error, an interrupt or an early close, so
+        # they write no more files
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+def join_parts(parts, o):
+    """Appends per-region part files to an open output in order and removes them"""
+    for part in parts:
+        with open(part, 'rb') as fh:
+            shutil.copyfileobj(fh, o, 1 << 22)
+        os.remove(part)
@@ -25,7 +25,7 @@ def load_ref():
     Loads the reference fasta file into a dictionary
     """
     dic = {}
-    ref_init = reference.Reference(handle=reffil)
+    ref_init = reference.Reference(handle=reffil, mapped=True, cache=True)
     for r in ref_init:
         scf = int(r.scaffold.replace('scaffold_',''))
         dic[scf] = r.len()
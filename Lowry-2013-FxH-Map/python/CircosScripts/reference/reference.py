@@ -9,22 +9,50 @@
 # You should have received a copy of the CC0 Public Domain Dedication along with
 # this software. If not, see <http://creativecommons.org/publicdomain/zero/1.0/>
 
+import os
 import gzip
+import mmap
+from collections import OrderedDict
+import twobit
 
 class Reference(object):
     """
     This class represents a FASTA formatted reference file.
     The constructor takes a filehandle and creates a generator
     which returns a subsequent scaffold.
+
+    Uncompressed files can also be read at random with fetch(), through a
+    samtools compatible .fai index that is loaded or built when needed.
+    With mapped = True the file is memory mapped instead of read, and the
+    scaffolds are iterated as SequenceViews that only copy bases out of the
+    map when sliced, so len() costs nothing and processes reading the same
+    genome share its page cache. Names are then the first word of the header.
+    With cache = True the same views are read from a 2-bit packed copy of
+    the genome, handle.2bit (see twobit.py), which is written on first use
+    and again whenever the FASTA changes size or modification time. It also
+    works for compressed FASTAs, but bases other than ACGT come back as N.
+    When handle.2bit cannot be written, the FASTA is read as without cache.
     """
-    def __init__(self, handle, compressed = False):
+    def __init__(self, handle, compressed = False, mapped = False, cache = False):
         self.handle = handle
         self.compressed = compressed
+        self.mapped = mapped
+        self.cache = cache
+        self.fai = None
+        self._fh = None
+        self._map = None
+        self._2bit = None
 
     def __iter__(self):
         scaff = ''
         seq   = []
-        if self.compressed:
+        if self.mapped or self.twobit():
+            for name in self.scaffolds():
+                self.scaffold = name
+                self.sequence = SequenceView(self, name)
+                yield self
+
+        elif self.compressed:
             for line in gzip.open(self.handle, 'rb'):
                 if line.startswith('>') and not scaff:
                     scaff = line.rstrip().replace('>', '')
@@ -63,3 +91,196 @@ class Reference(object):
 
     def write(self, ostream):
         ostream.write('>{0}\n{1}\n'.format(self.scaffold, self.sequence))
+
+    def index(self):
+        """
+        Returns the .fai index as an ordered dict of scaffold -> (length,
+        offset, line bases, line width). An up to date handle.fai is loaded,
+        otherwise the index is built and written next to the FASTA when
+        the directory is writable.
+        """
+        if self.fai is None:
+            if self.compressed:
+                raise ValueError('ERROR!! Random access needs an uncompressed FASTA: {0}'.format(self.handle))
+            fai = self.handle + '.fai'
+            if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(self.handle):
+                self.fai = read_fai(fai)
+            else:
+                self.fai = build_fai(self.handle)
+                try: write_fai(self.fai, fai)
+                except IOError: pass
+        return self.fai
+
+    def twobit(self):
+        """
+        Returns the TwoBit of the cache, writing handle.2bit first when it
+        is missing or was made from a FASTA of another size or modification
+        time (kept in handle.2bit.src). Returns None without cache, or when
+        the cache cannot be written next to the FASTA; the FASTA is then
+        read as if cache were False.
+        """
+        if self.cache and self._2bit is None:
+            path, src = self.handle + '.2bit', self.handle + '.2bit.src'
+            st = os.stat(self.handle)
+            current = '{0}\t{1!r}\n'.format(st.st_size, st.st_mtime)
+            stamp = None
+            if os.path.exists(path) and os.path.exists(src):
+                with open(src, 'rb') as fh:
+                    stamp = fh.read()
+            if stamp != current:
+                try:
+                    self._write_twobit(path)
+                    twobit.replace(src, lambda o: o.write(current))
+                except (IOError, OSError):
+                    self.cache = False
+                    return None
+            self._2bit = twobit.TwoBit(path)
+        return self._2bit
+
+    def _write_twobit(self, path):
+        """
+        Packs the scaffolds of the FASTA to a .2bit file
+        """
+        records = Reference(self.handle, compressed=self.compressed)
+        twobit.write(((r.scaffold.split()[0], r.sequence) for r in records), path)
+
+    def scaffolds(self):
+        """
+        Scaffold names in file order
+        """
+        if self.twobit(): return self._2bit.scaffolds()
+        return self.index().keys()
+
+    def length(self, scaffold):
+        """
+        Length of a scaffold, from the index
+        """
+        if self.twobit(): return self._2bit.length(scaffold)
+        return self.index()[scaffold][0]
+
+    def fetch(self, scaffold, start=0, end=None):
+        """
+        Returns scaffold[start:end] (0-based, end exclusive, clipped like a
+        string slice). Only the bytes of the range are read, and line
+        breaks are removed from those alone.
+        """
+        if self.twobit(): return self._2bit.fetch(scaffold, start, end)
+        length, offset, nbases, width = self.index()[scaffold]
+        start, end, _ = slice(start, end).indices(length)
+        if end <= start: return ''
+        first = offset + (start // nbases) * width + start % nbases
+        last  = offset + ((end - 1) // nbases) * width + (end - 1) % nbases + 1
+        data  = self._read(first, last)
+        if last - first == end - start: return data
+        return data.replace('\n', '').replace('\r', '')
+
+    def _read(self, first, last):
+        """
+        Bytes first to last of the file, from the map or a seek
+        """
+        if self.mapped:
+            if self._map is None:
+                with open(self.handle, 'rb') as fh:
+                    self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[first:last]
+        if self._fh is None: self._fh = open(self.handle, 'rb')
+        self._fh.seek(first)
+        return self._fh.read(last - first)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._2bit is not None:
+            self._2bit.close()
+            self._2bit = None
+
+class SequenceView(object):
+    """
+    Lazy view of one scaffold of an indexed Reference. Its length comes from
+    the index; bases are read, and line breaks removed, only when it is
+    sliced or turned into a string.
+    """
+    def __init__(self, ref, scaffold):
+        self.ref      = ref
+        self.scaffold = scaffold
+
+    def __len__(self):
+        return self.ref.length(self.scaffold)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                return str(self)[key]
+            return self.ref.fetch(self.scaffold, key.start, key.stop)
+        length = len(self)
+        if key < 0: key += length
+        if not 0 <= key < length:
+            raise IndexError('sequence index out of range')
+        return self.ref.fetch(self.scaffold, key, key + 1)
+
+    def __getslice__(self, start, stop):
+        # Python 2 passes simple slices here, with negatives already shifted
+        return self.ref.fetch(self.scaffold, max(start, 0), max(stop, 0))
+
+    def __str__(self):
+        return self.ref.fetch(self.scaffold)
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+def build_fai(path):
+    """
+    Indexes a FASTA file like 'samtools faidx'. Every line of a sequence but
+    the last must have the same length.
+    """
+    fai   = OrderedDict()
+    name  = None
+    pos   = 0
+    with open(path, 'rb') as fh:
+        for line in fh:
+            if line.startswith('>'):
+                if name is not None:
+                    fai[name] = (length, offset, nbases, width)
+                name   = line[1:].split()[0] if line[1:].strip() else ''
+                if name in fai:
+                    raise ValueError('ERROR!! Duplicate scaffold {0} in {1}'.format(name, path))
+                offset = pos + len(line)
+                length, nbases, width, short = 0, 0, 0, False
+            elif name is not None:
+                bases = len(line.rstrip('\r\n'))
+                if not bases:
+                    short = True
+                elif short or bases > nbases > 0 or \
+                     (bases == nbases and line.endswith('\n') and len(line) != width):
+                    raise ValueError('ERROR!! Different line lengths in {0} of {1}'.format(name, path))
+                else:
+                    if not nbases: nbases, width = bases, len(line)
+                    elif bases < nbases: short = True
+                    length += bases
+            pos += len(line)
+    if name is not None:
+        fai[name] = (length, offset, nbases, width)
+    return fai
+
+def read_fai(path):
+    """
+    Reads a .fai index
+    """
+    fai = OrderedDict()
+    with open(path, 'rU') as fh:
+        for line in fh:
+            cols = line.rstrip('\n').split('\t')
+            fai[cols[0]] = tuple(int(i) for i in cols[1:5])
+    return fai
+
+def write_fai(fai, path):
+    """
+    Writes a .fai index
+    """
+    with open(path, 'wb') as o:
+        for name, vals in fai.iteritems():
+            o.write('\t'.join([name] + [str(i) for i in vals]) + '\n')
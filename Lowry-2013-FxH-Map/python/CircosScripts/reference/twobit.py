@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# Although not required in any sense, share the love and pass on attribution
+# when using or modifying this code.
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along with
+# this software. If not, see <http://creativecommons.org/publicdomain/zero/1.0/>
+#
+# twobit.py - Reads and writes genomes in the UCSC .2bit format: 2 bits per
+# base, with tables of N blocks and of soft-masked (lower case) blocks, and an
+# offset directory of the scaffolds. Bases other than ACGT are stored as N, as
+# faToTwoBit does.
+
+import os
+import mmap
+import shutil
+import struct
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+signature = 0x1A412743
+
+# T C A G = 0 1 2 3, four bases to a byte with the first in the high bits
+codes = np.zeros(256, dtype=np.uint8)
+for b, c in zip('TCAG', range(4)):
+    codes[ord(b)] = codes[ord(b.lower())] = c
+is_n = np.ones(256, dtype=bool)
+is_n[[ord(i) for i in 'ACGTacgt']] = False
+bases = np.array([[ord('TCAG'[(i >> s) & 3]) for s in (6, 4, 2, 0)]
+                  for i in range(256)], dtype=np.uint8)
+
+def blocks(flags):
+    """
+    Returns the starts and sizes of the runs of True in a boolean array
+    """
+    d = np.diff(np.concatenate(([0], flags.view(np.int8), [0])))
+    starts = np.flatnonzero(d == 1)
+    return starts, np.flatnonzero(d == -1) - starts
+
+def pack(seq):
+    """
+    Returns the .2bit record of a sequence string
+    """
+    arr   = np.frombuffer(seq, dtype=np.uint8)
+    nst, nsz = blocks(is_n[arr])
+    mst, msz = blocks((arr >= ord('a')) & (arr <= ord('z')))
+    c = codes[arr]
+    if len(c) % 4:
+        c = np.concatenate((c, np.zeros(4 - len(c) % 4, dtype=np.uint8)))
+    c = c.reshape(-1, 4)
+    dna = (c[:, 0] << 6) | (c[:, 1] << 4) | (c[:, 2] << 2) | c[:, 3]
+    return ''.join([struct.pack('<II', len(seq), len(nst)),
+                    nst.astype('<u4').tostring(), nsz.astype('<u4').tostring(),
+                    struct.pack('<I', len(mst)),
+                    mst.astype('<u4').tostring(), msz.astype('<u4').tostring(),
+                    struct.pack('<I', 0), dna.astype(np.uint8).tostring()])
+
+def write(records, path):
+    """
+    Writes (name, sequence) records to a .2bit file. The records are packed
+    to a temporary file first, since the directory of offsets comes before
+    them; offsets are 64 bit (version 1) when the file passes 4Gb.
+    """
+    names, sizes = [], []
+    tmp = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        for name, seq in records:
+            rec = pack(seq)
+            tmp.write(rec)
+            names.append(name)
+            sizes.append(len(rec))
+
+        index   = 16 + sum(1 + len(i) + 4 for i in names)
+        version = 0
+        if index + sum(sizes) + 4 * len(names) >= 2 ** 32:
+            version = 1
+            index  += 4 * len(names)
+
+        def dump(o):
+            o.write(struct.pack('<IIII', signature, version, len(names), 0))
+            offset = index
+            for name, size in zip(names, sizes):
+                o.write(struct.pack('<B', len(name)) + name)
+                o.write(struct.pack('<Q' if version else '<I', offset))
+                offset += size
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, o, 4 * 1024 * 1024)
+        replace(path, dump)
+    finally:
+        tmp.close()
+
+def replace(path, dump):
+    """
+    Calls dump(fh) on a temporary file in the directory of path and renames
+    it over path, so other processes see the old file or the new one but
+    never a partly written one
+    """
+    fd, part = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as o:
+            dump(o)
+        # mkstemp makes the file private; give it the usual permissions
+        mask = os.umask(0)
+        os.umask(mask)
+        os.chmod(part, 0o666 & ~mask)
+        os.rename(part, path)
+    except:
+        os.remove(part)
+        raise
+
+class TwoBit(object):
+    """
+    Random access to a .2bit file through a read only memory map. Fetching
+    a range reads a quarter of its bases in bytes plus the N and mask
+    blocks that overlap it.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        sig, = struct.unpack('<I', self._map[:4])
+        if sig == signature: self.endian = '<'
+        elif sig == struct.unpack('>I', struct.pack('<I', signature))[0]: self.endian = '>'
+        else: raise ValueError('ERROR!! {0} is not a .2bit file'.format(path))
+        version, count = struct.unpack(self.endian + 'II', self._map[4:12])
+        width = 8 if version else 4
+        self.offsets = OrderedDict()
+        pos = 16
+        for _ in range(count):
+            size = ord(self._map[pos])
+            name = self._map[pos + 1:pos + 1 + size]
+            pos += 1 + size
+            self.offsets[name], = struct.unpack(self.endian + ('Q' if version else 'I'),
+                                                self._map[pos:pos + width])
+            pos += width
+        self._records = {}
+
+    def scaffolds(self):
+        """
+        Scaffold names in file order
+        """
+        return self.offsets.keys()
+
+    def length(self, scaffold):
+        """
+        Length of a scaffold
+        """
+        pos = self.offsets[scaffold]
+        return struct.unpack(self.endian + 'I', self._map[pos:pos + 4])[0]
+
+    def record(self, scaffold):
+        """
+        Returns (length, N starts, N sizes, mask starts, mask sizes, offset
+        of the packed bases) of a scaffold
+        """
+        if scaffold not in self._records:
+            pos   = self.offsets[scaffold]
+            dtype = np.dtype(self.endian + 'u4')
+            length, count = struct.unpack(self.endian + 'II', self._map[pos:pos + 8])
+            pos  += 8
+            nst   = np.frombuffer(self._map[pos:pos + 4 * count], dtype=dtype)
+            nsz   = np.frombuffer(self._map[pos + 4 * count:pos + 8 * count], dtype=dtype)
+            pos  += 8 * count
+            count, = struct.unpack(self.endian + 'I', self._map[pos:pos + 4])
+            pos  += 4
+            mst   = np.frombuffer(self._map[pos:pos + 4 * count], dtype=dtype)
+            msz   = np.frombuffer(self._map[pos + 4 * count:pos + 8 * count], dtype=dtype)
+            pos  += 8 * count + 4
+            self._records[scaffold] = (length, nst, nsz, mst, msz, pos)
+        return self._records[scaffold]
+
+    def fetch(self, scaffold, start=0, end=None):
+        """
+        Returns scaffold[start:end] (0-based, end exclusive, clipped like a
+        string slice)
+        """
+        length, nst, nsz, mst, msz, dna = self.record(scaffold)
+        start, end, _ = slice(start, end).indices(length)
+        if end <= start: return ''
+        packed = np.frombuffer(self._map[dna + start // 4:dna + (end + 3) // 4], dtype=np.uint8)
+        seq = bases[packed].ravel()[start % 4:start % 4 + end - start]
+        for st, sz, n in ((nst, nsz, True), (mst, msz, False)):
+            # Blocks are sorted and do not overlap, so only the one starting
+            # at or before 'start' and those starting before 'end' can touch
+            # the range
+            first = max(np.searchsorted(st, start, side='right') - 1, 0)
+            last  = np.searchsorted(st, end)
+            for b, z in zip(st[first:last].tolist(), sz[first:last].tolist()):
+                lo, hi = max(b, start) - start, min(b + z, end) - start
+                if lo >= hi: continue
+                if n: seq[lo:hi] = ord('N')
+                else: seq[lo:hi] |= 0x20
+        return seq.tostring()
+
+    def close(self):
+        self._map.close()
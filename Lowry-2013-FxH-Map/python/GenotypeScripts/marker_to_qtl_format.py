@@ -17,6 +17,7 @@ import sys
 import os
 import random
 import time
+import markermatrix
 
 FMAT_QTL = {'mst_map': {'A': 'A', 'B': 'B', 'H': 'X', '-': 'U'},
             'join_map': {'A': 'a', 'B': 'b', 'H': 'h', '-': '-'}}
@@ -36,7 +37,8 @@ def main():
     USAGE: marker_to_qtl_format.py matrix.tab out.file map_type max_missing seq_p reduce_scaff
 
     ARGUMENTS:
-    	matrix.tab   - output matrix from vcf_to_marker.py
+    	matrix.tab   - output matrix from vcf_to_marker.py, as text or as a
+                       2-bit binary .mkb matrix
         out.file     - name of output file
         map_type     - Type of output file [mst_map | rqtl | join_map]
         max_missing  - Limit for % of data missing (Float)
@@ -63,7 +65,7 @@ def process_matrix():
     header = []
     site_dict = {}
 
-    with open(in_matrix, 'rU') as f:
+    with open_input(in_matrix) as f:
         for line in f:
 
             if line.startswith('Loci'):
@@ -84,6 +86,10 @@ def process_matrix():
 
     return header, site_dict
 
+def open_input(path):
+    '''Opens the marker matrix, which can be text or a binary .mkb matrix'''
+    return markermatrix.open_input(path)
+
 def reduce_RAD(site_dict):
     '''Reduce to only one snp/RAD tag and return dictionary of best sites'''
     best = {}
@@ -35,6 +35,7 @@ import sys
 from scipy import stats
 import numpy as np
 import time
+import markermatrix
 
 # Global Parent ID Variables
 par_A = 'Hal2'
@@ -42,7 +43,8 @@ par_B = 'FIL2'
 F1    = 'FHF1'
 
 # Global Collections
-CHRM_DICT = {}
+CHRM_DICT  = {}
+FOX_STREAM = None
 ct_dict = {
   'Total SNPs': 0,
   'Not <aaxbb> Marker': 0,
@@ -65,13 +67,22 @@ def main():
     and output to tab delimited flat file.
     ---------------------------------------------------------
 
-    USAGE: vcf_to_marker.py <file.vcf> <BLAST.tab> <out.tab> <GQ_limit>
+    USAGE: vcf_to_marker.py <file.vcf> <BLAST.tab> <out.tab> <GQ_limit> [hash|merge]
 
     ARGUMENTS:
     	file.vcf  - VCF file from FH reads
         BLAST.tab - Formatted recip best-hits output from RecipBest
-        out.tab   - output file 
+        out.tab   - output file; written as a 2-bit binary matrix if it
+                    ends with .mkb
         GQ_limit  - Minimally acceptable GQ (Int)
+        mode      - Foxtail annotation (default hash):
+                    hash  - all BLAST intervals are held in memory
+                    merge - one pass over BLAST.tab alongside the VCF,
+                            holding only the intervals around the current
+                            SNP. BLAST.tab must have each scaffold's lines
+                            together and sorted by start and end, e.g.
+                            sort -s -k2,2 -k3,3n -k4,4n; scaffolds can be in
+                            any order. Fastest when the VCF is sorted.
     '''
     load_foxtail()
     process_vcf()
@@ -79,6 +90,11 @@ def main():
 
 def load_foxtail():
     '''Loads BLAST information'''
+    global FOX_STREAM
+    if mode == 'merge':
+        FOX_STREAM = FoxtailStream(blast_file)
+        return
+
     with open(blast_file, 'rU') as f:
         for line in f:
             cols = line.rstrip().split('\t')
@@ -91,7 +107,7 @@ def load_foxtail():
 
 def process_vcf():
     '''Process the VCF file'''
-    o = open(out_file, 'wb')
+    o = open_output(out_file)
 
     with open(vcf_file, 'rU') as f:
         for line in f:
@@ -135,6 +151,10 @@ def process_vcf():
                     ct_dict['Not SNP'] += 1
     o.close()
 
+def open_output(path):
+    '''Opens the marker matrix as text or, for .mkb files, binary'''
+    return markermatrix.open_output(path, 7)
+
 def get_samples(line):
     '''Get header'''
     samples_list = line.rstrip().split('\t')[9::]
@@ -214,17 +234,20 @@ def print_row_with_stats(marker_class, f2_genotypes, base, kids_list, loci, o):
         observed, pval = get_seg_dist(curr_GTs)
 
         # Get Foxtail information
-        try:
-            scf = loci.split(':')[0]
-            st  = int(loci.split(':')[1])
-            curr_pos = CHRM_DICT[scf]
+        scf = loci.split(':')[0]
+        st  = int(loci.split(':')[1])
+        if FOX_STREAM is not None:
+            fox_c = FOX_STREAM.lookup(scf, st)
+        else:
+            try:
+                curr_pos = CHRM_DICT[scf]
             
-            fox_c = 'NA'
-            for i in sorted(curr_pos.keys()):
-                if st in range(i[0], i[1]):
-                    fox_c = curr_pos[i] 
-        except:
-            fox_c = 'NA'
+                fox_c = 'NA'
+                for i in sorted(curr_pos.keys()):
+                    if i[0] <= st < i[1]:
+                        fox_c = curr_pos[i] 
+            except:
+                fox_c = 'NA'
         # Write to flat file
         o.write('\t'.join([loci, fox_c, marker_class, 
                     '{:0.2F}'.format(avg_depth), 
@@ -233,6 +256,60 @@ def print_row_with_stats(marker_class, f2_genotypes, base, kids_list, loci, o):
                     observed, '{:0.2E}'.format(pval)] +\
                     curr_GTs) + '\n')
 
+class FoxtailStream(object):
+    '''
+    Foxtail chromosome of SNP positions from a merge join with the BLAST
+    table. A first pass only notes where each scaffold's block starts; the
+    block is then read along with the SNPs of that scaffold, keeping the
+    intervals that started at or before the SNP and have not ended yet.
+    Going back on a scaffold re-reads its block from the start.
+    '''
+    def __init__(self, path):
+        self.path    = path
+        self.fh      = open(path, 'rb')
+        self.offsets = {}
+        self.scf     = None
+        prev         = None
+        pos          = 0
+        for line in iter(self.fh.readline, ''):
+            scf = line.split('\t', 2)[1]
+            if scf != prev:
+                if scf in self.offsets:
+                    raise ValueError('ERROR!! The lines of scaffold {0} are not together in {1}'.format(scf, path))
+                self.offsets[scf] = pos
+                prev = scf
+            pos += len(line)
+
+    def seek(self, scf):
+        '''Starts reading the block of a scaffold'''
+        self.fh.seek(self.offsets[scf])
+        self.scf    = scf
+        self.last   = None
+        self.key    = None
+        self.active = []
+        self.next   = self.read()
+
+    def read(self):
+        '''Next (start, end, chrom) of the current scaffold or None'''
+        cols = self.fh.readline().rstrip().split('\t')
+        if len(cols) < 4 or cols[1] != self.scf: return None
+        key = (int(cols[2]), int(cols[3]))
+        if self.key is not None and key < self.key:
+            raise ValueError('ERROR!! Scaffold {0} is not sorted by start and end in {1}'.format(self.scf, self.path))
+        self.key = key
+        return key + (cols[0].replace('chr',''),)
+
+    def lookup(self, scf, st):
+        '''Chromosome of the last (by start, end) interval with start <= st < end'''
+        if scf not in self.offsets: return 'NA'
+        if scf != self.scf or st < self.last: self.seek(scf)
+        self.last = st
+        while self.next is not None and self.next[0] <= st:
+            self.active.append(self.next)
+            self.next = self.read()
+        self.active = [i for i in self.active if i[1] > st]
+        return self.active[-1][2] if self.active else 'NA'
+
 def get_seg_dist(GTs):
     '''Checks for segregation distortion. Returns ratio string and pvalue'''
     observed = np.hstack([GTs.count('A'), GTs.count('H'), GTs.count('B')])
@@ -251,7 +328,8 @@ def print_summary():
     print 'Potential Markers:', ct_dict['Potential Marker']
 
 if __name__=='__main__':
-    if len(sys.argv) != 5:
+    if len(sys.argv) not in (5, 6) or \
+       (len(sys.argv) == 6 and sys.argv[5] not in ('hash', 'merge')):
         print main.__doc__
         sys.exit()
     start      = time.time()
@@ -259,5 +337,6 @@ if __name__=='__main__':
     blast_file = sys.argv[2]
     out_file   = sys.argv[3]
     GQ_limit   = int(sys.argv[4])
+    mode       = sys.argv[5] if len(sys.argv) == 6 else 'hash'
     main()
     print "Finished; Took:", time.time() - start, "seconds."
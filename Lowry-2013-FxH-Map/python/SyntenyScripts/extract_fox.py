@@ -12,6 +12,9 @@
 #
 import sys
 import time
+import blasttab
+# FASTA access (reference.py in CircosScripts/reference, needs to be on the PYTHONPATH)
+import reference
 
 def main():
     """
@@ -27,7 +30,7 @@ def main():
 
     ARGUMENTS:
     	inbest.tab  - Tab delimited output from Blast Parser
-        infasta.fa  - The Foxtail reference
+        infasta.fa  - The Foxtail reference (indexed to infasta.fa.fai on first use)
         outfasta.fa - The output file for the cut Foxtail reference.
     """ 
     cut_dict = get_cut_sites()
@@ -39,59 +42,44 @@ def get_cut_sites():
     """
     dic = {}
 
-    with open(inbest, 'rU') as f:
-        for line in f:
-            cols = line.rstrip().split('\t')
-            ch   = cols[1]
-            p1   = min([int(cols[8]), int(cols[9])])
-            p2   = max([int(cols[8]), int(cols[9])])
-            if p1 - 1 < 0: start = 0
-            else: start = p1 - 1
-            
-            val  = (start, p2)
-            if ch not in dic: dic[ch] = []
-            dic[ch].append(val)
+    for hit in blasttab.parse(blasttab.lines(inbest)):
+        ch   = hit.subject
+        p1   = hit.smin
+        p2   = hit.smax
+        if p1 - 1 < 0: start = 0
+        else: start = p1 - 1
+        
+        val  = (start, p2)
+        if ch not in dic: dic[ch] = []
+        dic[ch].append(val)
 
     return dic
 
 def process_reference(dic):
     """
-    Reads in the Foxtail fasta reference file and cuts at given positions.
+    Cuts the given positions out of the Foxtail fasta reference file, reading
+    only the bytes of the cuts through its .fai index.
     """
     print 'Processing reference...'
 
-    curr_scaff = ''
-    curr_seq   = []
     o = open(outfasta, 'wb')
-
-    with open(infasta, 'rU') as f:
-        for line in f:
-            if line.startswith('>') and not curr_scaff:
-                curr_scaff = line.rstrip().split('>')[1]
-
-            elif line.startswith('>') and curr_scaff:
-                seq = ''.join(curr_seq)
-                cuts = process_scaff(curr_scaff, dic[curr_scaff], seq)
-                [print_cuts(j, curr_scaff, o) for j in cuts]
-
-                curr_scaff = line.rstrip().split('>')[1]
-                curr_seq   = []
-
-            else:
-                curr_seq.append(line.rstrip())
-        seq = ''.join(curr_seq)
-        cuts = process_scaff(curr_scaff, dic[curr_scaff], seq)
+    ref = reference.Reference(handle=infasta)
+    for curr_scaff in ref.scaffolds():
+        if curr_scaff not in dic: continue
+        cuts = process_scaff(ref, curr_scaff, dic[curr_scaff])
         [print_cuts(j, curr_scaff, o) for j in cuts]
+    ref.close()
     o.close()
 
-def process_scaff(scf, pos, seq):
+def process_scaff(ref, scf, pos):
     """
     Returns cut sites.
     """
-    for i in pos:
-        if not seq[i[0]:i[1]]:
-            print scf, i, len(seq)
-    return [(i, seq[i[0]:i[1]]) for i in pos if seq[i[0]:i[1]]]
+    cuts = [(i, ref.fetch(scf, i[0], i[1])) for i in pos]
+    for i, seq in cuts:
+        if not seq:
+            print scf, i, ref.length(scf)
+    return [i for i in cuts if i[1]]
 
 def print_cuts(c, s, o):
     """
@@ -12,6 +12,11 @@
 #
 import sys
 import time
+from collections import OrderedDict
+import blasttab
+# FASTA access (reference.py in CircosScripts/reference, needs to be on the PYTHONPATH)
+import reference
+import intervals
 
 def main():
     """
@@ -24,16 +29,25 @@ def main():
     Foxtail genome. Creates a fasta file of these sites for blasting.
     ---------------------------------------------------------------------------
 
-    USAGE: ExtractHal.py inbest.tab hxf.vcf hallii.fa outfasta.fa
+    USAGE: ExtractHal.py inbest.tab hxf.vcf hallii.fa outfasta.fa [windows|clusters [max_len]]
 
     ARGUMENTS:
     	inbest.tab  - Tab delimited output from Blast Parser of Fox exons on Hallii
         hxf.vcf     - HxF VCF file.
-        hallii.fa   - The P hallii reference
+        hallii.fa   - The P hallii reference (indexed to hallii.fa.fai on first use)
         outfasta.fa - The output file for the cut Hallii reference.
+        mode        - windows (default): one +/-100bp window per SNP
+                      clusters: overlapping or adjacent windows are merged
+                      and each cluster is written once. outfasta.fa.snps.tab
+                      maps every SNP (scaffold, VCF position) to its cluster
+                      and its 0-based offset in it.
+        max_len     - clusters are not grown past this length (default none)
     """
     cut_dict = get_cut_sites()
     snp_dict = find_snps(cut_dict)
+    if mode == 'clusters':
+        snp_dict = cluster_snps(snp_dict)
+        write_snp_table(snp_dict)
     process_reference(snp_dict)
 
 def get_cut_sites():
@@ -42,18 +56,16 @@ def get_cut_sites():
     """
     dic = {}
 
-    with open(inbest, 'rU') as f:
-        for line in f:
-            cols = line.rstrip().split('\t')
-            ch   = cols[1]
-            p1   = min([int(cols[8]), int(cols[9])])
-            p2   = max([int(cols[8]), int(cols[9])])
-            if p1 - 1 < 0: start = 0
-            else: start = p1 - 1
-            
-            val  = (start, p2)
-            if ch not in dic: dic[ch] = []
-            dic[ch].append(val)
+    for hit in blasttab.parse(blasttab.lines(inbest)):
+        ch   = hit.subject
+        p1   = hit.smin
+        p2   = hit.smax
+        if p1 - 1 < 0: start = 0
+        else: start = p1 - 1
+        
+        val  = (start, p2)
+        if ch not in dic: dic[ch] = []
+        dic[ch].append(val)
 
     return dic
 
@@ -62,6 +74,7 @@ def find_snps(cut_dict):
     Finds SNPs within the VCF file that occur in the best hit blast regions.
     """
     dic = {}
+    index = intervals.build(cut_dict)
 
     with open(invcf, 'rU') as f:
         for line in f:
@@ -72,57 +85,72 @@ def find_snps(cut_dict):
                 po   = int(cols[1]) - 1
            
                 try: 
-                    curr_cut = cut_dict[ch]
-                    L = [i for i in curr_cut if i[0] <= po <= i[1]]
-                    if L:
+                    if index[ch].contains(po):
                         if po - 100 < 0: start = 0
                         else: start = po - 100
                         end = po + 101
                         key = (start, end) 
                         if ch not in dic: dic[ch] = {}
-                        dic[ch][key] = ''
+                        dic[ch][key] = [po]
                 except KeyError: pass 
     return dic
 
+def cluster_snps(dic):
+    """
+    Merges the overlapping or adjacent SNP windows of each scaffold in a
+    sweep over the windows sorted by start, keeping clusters within
+    max_len. Returns {scaffold: {(start, end): [SNP positions]}} with the
+    clusters in order.
+    """
+    clusters = {}
+    for ch in dic:
+        curr = clusters[ch] = OrderedDict()
+        cs, ce, snps = None, None, []
+        for (start, end), pos in sorted(dic[ch].iteritems()):
+            if cs is not None and start <= ce and \
+               (max_len is None or max(ce, end) - cs <= max_len):
+                ce = max(ce, end)
+                snps.extend(pos)
+            else:
+                if cs is not None: curr[(cs, ce)] = snps
+                cs, ce, snps = start, end, list(pos)
+        if cs is not None: curr[(cs, ce)] = snps
+    return clusters
+
+def write_snp_table(dic):
+    """
+    Writes the cluster of every SNP and the SNP's 0-based offset in it
+    """
+    with open(outfasta + '.snps.tab', 'wb') as o:
+        o.write('#scaffold\tposition\tcluster\toffset\n')
+        for ch in sorted(dic):
+            for (start, end), pos in dic[ch].iteritems():
+                name = str(ch) + '_' + str(start) + '_' + str(end)
+                for po in sorted(pos):
+                    o.write('{0}\t{1}\t{2}\t{3}\n'.format(ch, po + 1, name, po - start))
+
 def process_reference(dic):
     """
-    Reads in the Foxtail fasta reference file and cuts at given positions.
+    Cuts the given positions out of the Hallii fasta reference file, reading
+    only the bytes of the cuts through its .fai index.
     """
     print 'Processing reference...'
 
-    curr_scaff = ''
-    curr_seq   = []
     o = open(outfasta, 'wb')
-
-    with open(infasta, 'rU') as f:
-        for line in f:
-            if line.startswith('>') and not curr_scaff:
-                curr_scaff = line.rstrip().replace('>Scaffold', '')
-
-            elif line.startswith('>') and curr_scaff:
-                try:
-                    seq = ''.join(curr_seq)
-                    cuts = process_scaff(curr_scaff, dic[curr_scaff].keys(), seq)
-                    [print_cuts(j, curr_scaff, o) for j in cuts]
-                except KeyError: pass
-
-                curr_scaff = line.rstrip().replace('>Scaffold', '')
-                curr_seq   = []
-
-            else:
-                curr_seq.append(line.rstrip())
-        try:
-            seq = ''.join(curr_seq)
-            cuts = process_scaff(curr_scaff, dic[curr_scaff].keys(), seq)
-            [print_cuts(j, curr_scaff, o) for j in cuts]
-        except KeyError: pass
+    ref = reference.Reference(handle=infasta)
+    for name in ref.scaffolds():
+        curr_scaff = ('>' + name).replace('>Scaffold', '')
+        if curr_scaff not in dic: continue
+        cuts = process_scaff(ref, name, dic[curr_scaff].keys())
+        [print_cuts(j, curr_scaff, o) for j in cuts]
+    ref.close()
     o.close()
 
-def process_scaff(scf, pos, seq):
+def process_scaff(ref, scf, pos):
     """
     Returns cut sites.
     """
-    return [(i, seq[i[0]:i[1]]) for i in pos]
+    return [(i, ref.fetch(scf, i[0], i[1])) for i in pos]
 
 def print_cuts(c, s, o):
     """
@@ -133,12 +161,15 @@ def print_cuts(c, s, o):
 
 if __name__ == '__main__':
     start = time.time()
-    if len(sys.argv) != 5:
+    if len(sys.argv) not in (5, 6, 7) or \
+       (len(sys.argv) > 5 and sys.argv[5] not in ('windows', 'clusters')):
         print main.__doc__
         sys.exit()
     inbest   = sys.argv[1]
     invcf    = sys.argv[2]
     infasta  = sys.argv[3]
     outfasta = sys.argv[4]
+    mode     = sys.argv[5] if len(sys.argv) > 5 else 'windows'
+    max_len  = int(sys.argv[6]) if len(sys.argv) > 6 else None
     main()
     print "Finished; Took:", time.time() - start, "seconds."
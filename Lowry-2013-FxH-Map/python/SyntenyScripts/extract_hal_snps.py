@@ -13,6 +13,8 @@
 import sys
 import time
 import re
+import blasttab
+import intervals
 
 def main():
     """
@@ -55,17 +57,16 @@ def get_cut_sites(exon):
     """
     dic = {}
 
-    with open(inbest, 'rU') as f:
-        for line in f:
-            cols = line.rstrip().split('\t')
-            query = cols[0]
-            ch   = cols[1]
-            p1   = min([int(cols[8]), int(cols[9])])
-            p2   = max([int(cols[8]), int(cols[9])])
-            
-            val  = (p1, p2, query, exon[query])
-            if ch not in dic: dic[ch] = {} 
-            dic[ch][val] = [cols[10],cols[11]]
+    for hit in blasttab.parse(blasttab.lines(inbest)):
+        cols  = hit.columns()
+        query = hit.query
+        ch    = hit.subject
+        p1    = hit.smin
+        p2    = hit.smax
+        
+        val  = (p1, p2, query, exon[query])
+        if ch not in dic: dic[ch] = {} 
+        dic[ch][val] = [cols[10],cols[11]]
 
     return dic
 
@@ -74,6 +75,7 @@ def find_snps(cut_dict):
     Finds SNPs within the VCF file that occur in the best hit blast regions.
     """
     dic = {}
+    index = dict((ch, intervals.IntervalIndex(cut_dict[ch].keys())) for ch in cut_dict)
     o = open(outfil, 'wb')
     o.write('FHCHRM\tFHPOS\tFM_PACID\tFMCHRM\tFMORI\tFMSTART\tFMEND\tEVALUE\tSCORE\tKEY\n')
     with open(invcf, 'rU') as f:
@@ -85,8 +87,7 @@ def find_snps(cut_dict):
                 po   = int(cols[1])
            
                 try: 
-                    curr_cut = cut_dict[ch]
-                    L = [i for i in curr_cut.keys() if i[0] <= po <= i[1]]
+                    L = index[ch].find(po)
                     if L:
                         for j in L:
                             query = j[2].split('_')
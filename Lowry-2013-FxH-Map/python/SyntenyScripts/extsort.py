@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Kyle Hernandez
+#
+# extsort.py - External merge sort of text lines, for files that do not fit
+# in memory. Sorted runs are spilled to temporary files and merged back.
+# Although not required in any sense, share the love and pass on attribution
+# when using or modifying this code.
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along with
+# this software. If not, see <http://creativecommons.org/publicdomain/zero/1.0/>
+#
+import os
+import heapq
+import tempfile
+from itertools import islice
+
+# Number of lines held in memory per sorted run
+run_size = 500000
+
+def first_column(line):
+    """
+    Sort key on the first tab delimited column
+    """
+    return line.split('\t', 1)[0]
+
+def sort_lines(lines, key=first_column, size=run_size, tmpdir=None):
+    """
+    Yields the lines sorted by key. The sort is stable, so lines with the
+    same key keep their input order. Runs of 'size' lines are sorted in
+    memory and spilled to temporary files in tmpdir (default $TMPDIR), which
+    are removed when the generator finishes or is closed.
+    """
+    lines = iter(lines)
+    run   = sorted(islice(lines, size), key=key)
+    nxt   = list(islice(lines, size))
+
+    # Small inputs never touch the disk
+    if not nxt:
+        for line in run:
+            yield line
+        return
+
+    runs = []
+    try:
+        while run:
+            runs.append(spill(run, tmpdir))
+            run = sorted(nxt, key=key)
+            nxt = list(islice(lines, size))
+        del run, nxt
+
+        handles = [open(i, 'rb') for i in runs]
+        try:
+            # (key, run index) is unique in the heap, so lines are never compared
+            # and ties come out in input order
+            decorated = [decorate(fh, n, key) for n, fh in enumerate(handles)]
+            for item in heapq.merge(*decorated):
+                yield item[2]
+        finally:
+            for fh in handles: fh.close()
+    finally:
+        for i in runs:
+            os.remove(i)
+
+def decorate(fh, n, key):
+    """
+    Yields (key, n, line) for the lines of run n
+    """
+    for line in fh:
+        yield key(line), n, line
+
+def spill(run, tmpdir=None):
+    """
+    Writes a sorted run to a temporary file and returns its path. A last
+    line without a newline gets one so it stays a line of its own.
+    """
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    with os.fdopen(fd, 'wb') as o:
+        for line in run:
+            o.write(line if line.endswith('\n') else line + '\n')
+    return path
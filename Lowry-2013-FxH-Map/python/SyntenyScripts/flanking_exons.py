@@ -256,7 +256,7 @@ def load_reflen():
     Loads lengths of scaffolds into dict
     """
     dic = {}
-    for r in reference.Reference(handle=reffa):
+    for r in reference.Reference(handle=reffa, mapped=True, cache=True):
         scf = int(r.scaffold.replace('scaffold_',''))
         dic[scf] = r.len()
     return dic
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Kyle Hernandez
+#
+# intervals.py - Interval index for position lookups, such as SNPs falling
+# in BLAST hit regions.
+# Although not required in any sense, share the love and pass on attribution
+# when using or modifying this code.
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along with
+# this software. If not, see <http://creativecommons.org/publicdomain/zero/1.0/>
+#
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+class IntervalIndex(object):
+    """
+    Index of closed intervals [start, end] on one scaffold. The intervals
+    are any sequences whose first two items are start and end (tuples with
+    extra data are fine), and they come back in the order they were given.
+
+    find() walks a nested containment list: siblings are sorted by both
+    start and end, so each level is entered with one bisect and the
+    lookup takes O(log n + matches). contains() bisects the union of the
+    intervals.
+    """
+    def __init__(self, intervals):
+        self.items = list(intervals)
+        order = sorted(range(len(self.items)),
+                       key=lambda i: (self.items[i][0], -self.items[i][1]))
+
+        # Nested containment list: each node is [starts, ends, ids, children]
+        self.root = [[], [], [], []]
+        stack = []
+        for i in order:
+            start, end = self.items[i][0], self.items[i][1]
+            while stack and stack[-1][1] < end:
+                stack.pop()
+            parent = stack[-1][2] if stack else self.root
+            node = [[], [], [], []]
+            parent[0].append(start)
+            parent[1].append(end)
+            parent[2].append(i)
+            parent[3].append(node)
+            stack.append((start, end, node))
+
+        # Union of the intervals as sorted, disjoint [start, end] segments
+        self.seg_starts, self.seg_ends = [], []
+        for i in order:
+            start, end = self.items[i][0], self.items[i][1]
+            if self.seg_ends and start <= self.seg_ends[-1]:
+                self.seg_ends[-1] = max(self.seg_ends[-1], end)
+            else:
+                self.seg_starts.append(start)
+                self.seg_ends.append(end)
+
+    def __len__(self):
+        return len(self.items)
+
+    def find(self, pos):
+        """
+        Returns the intervals that contain pos, in input order
+        """
+        hits  = []
+        nodes = [self.root]
+        while nodes:
+            starts, ends, ids, children = nodes.pop()
+            k = bisect_left(ends, pos)
+            while k < len(starts) and starts[k] <= pos:
+                hits.append(ids[k])
+                if children[k][0]: nodes.append(children[k])
+                k += 1
+        return [self.items[i] for i in sorted(hits)]
+
+    def contains(self, pos):
+        """
+        True when an interval contains pos
+        """
+        k = bisect_right(self.seg_starts, pos) - 1
+        return k >= 0 and pos <= self.seg_ends[k]
+
+    def find_all(self, positions):
+        """
+        find() for each position of an array
+        """
+        return [self.find(p) for p in np.asarray(positions).tolist()]
+
+    def contains_all(self, positions):
+        """
+        Boolean array, True where an interval contains the position
+        """
+        positions = np.asarray(positions)
+        if not self.seg_starts: return np.zeros(positions.shape, dtype=bool)
+        k = np.searchsorted(self.seg_starts, positions, side='right') - 1
+        ends = np.asarray(self.seg_ends)
+        return (k >= 0) & (positions <= ends[np.maximum(k, 0)])
+
+def build(dic):
+    """
+    Returns {scaffold: IntervalIndex} for a dict of scaffold -> intervals
+    """
+    return dict((ch, IntervalIndex(dic[ch])) for ch in dic)
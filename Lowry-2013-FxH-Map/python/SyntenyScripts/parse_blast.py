@@ -14,9 +14,13 @@
 #
 import time
 import sys
-from operator import itemgetter
-import random
+import os
+from operator import itemgetter, attrgetter
+import zlib
 import collections
+import numpy as np
+import blasttab
+import extsort
 
 def main():
     """
@@ -27,129 +31,254 @@ def main():
     Parses out the best hits from Blastn
     ---------------------------------------------------------------------------
 
-    USAGE: ParseBlast.py blast.tab out.tab
+    USAGE: ParseBlast.py blast.tab out.tab [memory|stream|grouped|sort] [seed]
 
     ARGUMENTS:
          blast.tab - tab delimited Blast output file
-         out.tab   - tab delimited best hits file
+         out.tab   - tab delimited best hits file, written to out.tab.part
+                     and renamed when the run succeeds
+         mode      - how the hits are collected (default memory):
+                     memory  - all hits are held in memory as a table and
+                               resolved with grouped array operations
+                     stream  - one query at a time; the hits of a query must
+                               be consecutive, as in raw Blast output. The
+                               best hits keep the input order of the queries.
+                               The query names are kept to check this.
+                     grouped - stream without the check, for inputs known to
+                               be grouped by query; memory is bounded by the
+                               largest query.
+                     sort    - the hits are first sorted by query on disk
+                               ($TMPDIR), then streamed. For inputs that are
+                               not grouped by query.
+                     All modes pick the same best hits; memory and sort
+                     give the same file, sorted by query.
+         seed      - seed of the choice between tied hits (default 0)
     """
-    blast_dict = blastdict_builder()
-    process_dict(blast_dict)
+    try:
+        if mode == 'memory':
+            process_table(blast_table())
+        elif mode in ('stream', 'grouped'):
+            process_queries(stream_queries(blasttab.lines(blast_fil), check=mode == 'stream'))
+        else:
+            process_queries(stream_queries(sorted_lines(), check=False))
+        os.rename(part_fil, out_fil)
+    finally:
+        if os.path.exists(part_fil): os.remove(part_fil)
 
-def blastdict_builder():
+def good_hit(hit):
     """
-    Creates the dictionary of blast hits
+    Hits with e-value <= 1e-9 are kept
     """
-    dic = {} 
-    with open(blast_fil, 'rU') as f:
-        for line in f:
-            cols   = line.rstrip().split('\t')
-            query  = cols[0]
-            target = cols[1]
-            evalue = float(cols[10])
+    return hit.evalue <= float(10e-10)
 
-            if evalue <= float(10e-10):
-               data = [int(i) if n == 6 or n == 7 else float(i) if n == 8 or n == 9 else i for n,i in enumerate(cols[2::])]
-               if query not in dic: dic[query] = {}
-               if target not in dic[query]: dic[query][target] = []
-               dic[query][target].append(data)
-    return dic
+def blast_table():
+    """
+    Reads the kept hits into a columnar table. Query ids follow the sorted
+    query names, and hits keep their file order.
+    """
+    qids, tids = {}, {}
+    qcol, tcol, evalue, bitscore, lines = [], [], [], [], []
+    for hit in good_hits():
+        qcol.append(qids.setdefault(hit.query, len(qids)))
+        tcol.append(tids.setdefault(hit.subject, len(tids)))
+        evalue.append(hit.evalue)
+        bitscore.append(hit.bitscore)
+        lines.append(hit.line)
+
+    names = sorted(qids)
+    rank  = np.empty(len(names), dtype=np.int64)
+    rank[[qids[i] for i in names]] = np.arange(len(names))
+    return {'query'   : rank[np.array(qcol, dtype=np.int64)],
+            'target'  : np.array(tcol, dtype=np.int64),
+            'evalue'  : np.array(evalue, dtype=float),
+            'bitscore': np.array(bitscore, dtype=float),
+            'names'   : names,
+            'lines'   : lines}
+
+def good_hits():
+    """
+    Yields the kept hits in file order
+    """
+    for hit in blasttab.parse(blasttab.lines(blast_fil)):
+        if good_hit(hit): yield hit
 
-def process_dict(dic):
+def sorted_lines():
     """
-    Finds the best hit based on the filtered hits in the dictionary.
+    Yields the lines of the kept hits sorted by query with an external sort,
+    hits of the same query stay in file order
+    """
+    lines = (hit.line + '\n' for hit in good_hits())
+    return extsort.sort_lines(lines)
+
+def stream_queries(lines, check=True):
+    """
+    Groups the kept hits of Blast output that is grouped by query into
+    (query, {target: hits}), one query at a time.
+
+    BLAST writes the queries in the order of the query FASTA, not sorted, so
+    comparing a query with the previous one cannot tell a new query from one
+    that came back. With check the names of the queries already done are kept
+    in a set to catch that: one string per query, small next to the hits, but
+    it grows with the number of queries. The grouped mode leaves it out, and
+    so does the sort mode, since its hits are sorted by query.
+    """
+    seen = set()
+    for q, grp in blasttab.groups(lines):
+        if check:
+            if q in seen:
+                raise ValueError('ERROR!! The hits of {0} are not consecutive in {1}; '
+                                 'use the sort mode'.format(q, blast_fil))
+            seen.add(q)
+        dic = {}
+        for hit in grp:
+            if not good_hit(hit): continue
+            if hit.subject not in dic: dic[hit.subject] = []
+            dic[hit.subject].append(hit)
+        if dic: yield q, dic
+
+def format_hit(hit):
+    """
+    Formats the columns of a best hit after the query and target
+    """
+    cols = hit.columns()
+    return '\t'.join(cols[2:8] + [str(hit.sstart), str(hit.send), 
+                     str(hit.evalue), str(hit.bitscore)] + cols[12:])
+
+def tie_break(q, n):
+    """
+    Picks one of n tied hits of query q, in file order. Depends only on
+    the seed and the query, so every mode makes the same choice.
+    """
+    return (zlib.crc32('{0}\t{1}'.format(seed, q)) & 0xffffffff) % n
+
+def best_hit(q, hits):
+    """
+    Finds the best hit of a query from its {target: hits} dictionary.
+    Returns (target, hit), or None when there is no single best hit.
+    """
+    chr_hits = sorted(hits.keys())
+
+    if len(chr_hits) == 1:
+        best_ch = chr_hits[0]
+
+    # Deal with sequences that blast to multiple scaffolds
+    # finding the scaffold with the minimum sum e-value
+    else:
+        curr_sums = {} 
+        for c in chr_hits:
+            if c not in curr_sums: 
+                curr_sums[c] = 0
+            curr_data = hits[c]
+            curr_sums[c] += sum([i.evalue for i in curr_data])
+        
+        L = sorted(curr_sums.iteritems(), key=itemgetter(1))
+        
+        if L[0][1] < L[1][1]:
+            best_ch = L[0][0]
+        else: return None
+
+    curr_data = hits[best_ch]
+
+    if len(curr_data) == 1:
+        return best_ch, curr_data[0]
+
+    K = sorted(curr_data, key=attrgetter('evalue'))
+
+    if len(set([i.evalue for i in K[0:2]])) == 2:
+        return best_ch, K[0]
+    elif K[0].bitscore > K[1].bitscore:
+        return best_ch, K[0]
+    elif K[0].bitscore < K[1].bitscore:
+        return best_ch, K[0]
+    elif len(set([i.evalue for i in K])) == 1: 
+        return best_ch, K[tie_break(q, len(K))]
+    else: return None
+
+def resolve_table(tab):
+    """
+    Runs the rules of best_hit over the whole hit table with grouped
+    reductions and returns the indices of the best hits in query order.
+    """
+    q, t  = tab['query'], tab['target']
+    ev, bs = tab['evalue'], tab['bitscore']
+    n = len(ev)
+    if not n: return np.array([], dtype=np.int64)
+
+    # Hits sorted by query, target, e-value and file order; each (query,
+    # target) group starts with its first minimum e-value hit
+    order = np.lexsort((np.arange(n), ev, t, q))
+    qs, ts = q[order], t[order]
+    new   = np.ones(n, dtype=bool)
+    new[1:] = (qs[1:] != qs[:-1]) | (ts[1:] != ts[:-1])
+    start = np.flatnonzero(new)
+    size  = np.diff(np.append(start, n))
+    gq    = qs[start]
+
+    # Sum of e-values per scaffold, added in file order
+    gid = np.empty(n, dtype=np.int64)
+    gid[order] = np.cumsum(new) - 1
+    gsum = np.bincount(gid, weights=ev, minlength=len(start))
+
+    # Scaffold with the single minimum sum of each query (query ids are
+    # 0..N-1, one per run of groups)
+    qstart = np.flatnonzero(np.append(True, gq[1:] != gq[:-1]))
+    qmin   = np.minimum.reduceat(gsum, qstart)
+    ismin  = gsum == qmin[gq]
+    nmin   = np.bincount(gq, weights=ismin)
+    best   = np.flatnonzero(ismin & (nmin[gq] == 1))
+
+    # Best hit within the scaffold
+    s0, sz = start[best], size[best]
+    s1     = np.minimum(s0 + 1, n - 1)
+    last   = s0 + sz - 1
+    evs    = ev[order]
+    bss    = bs[order]
+    single = sz == 1
+    lone   = ~single & (evs[s0] != evs[s1])
+    score  = ~single & ~lone & (bss[s0] != bss[s1])
+    tied   = ~single & ~lone & ~score & (evs[s0] == evs[last])
+
+    pick = np.where(single | lone | score, s0, -1)
+    for i in np.flatnonzero(tied):
+        pick[i] = s0[i] + tie_break(tab['names'][gq[best[i]]], sz[i])
+    return order[pick[pick >= 0]]
+
+def process_table(tab):
+    """
+    Finds the best hits of the hit table and writes them to file.
+    """
+    chosen = resolve_table(tab)
+    with open(part_fil, 'wb') as o:
+        for hit in blasttab.convert([tab['lines'][i] for i in chosen]):
+            o.write(hit.query + '\t' + hit.subject + '\t' + format_hit(hit) + '\n')
+
+    print "Number of best hits:", len(chosen)
+
+def process_queries(queries):
+    """
+    Finds the best hit of each (query, {target: hits}) and writes them to
+    file.
     """
     num_match = 0
-    with open(out_fil, 'wb') as o:
-        for q in sorted(dic):
-            chr_hits = sorted(dic[q].keys())
-
-            if len(chr_hits) == 1:
-                curr_data = dic[q][chr_hits[0]]
-
-                if len(curr_data) == 1:
-                    num_match += 1
-                    o.write(q + '\t' + chr_hits[0] + '\t' + \
-                           '\t'.join([str(i) for i in curr_data[0]]) + '\n')
-    
-                else:
-                    L = sorted(curr_data, key=itemgetter(8))
-                    
-                    if len(set([i[8] for i in L[0:2]])) == 2:
-                        num_match += 1
-                        o.write(q + '\t' + chr_hits[0] + '\t' + \
-                           '\t'.join([str(i) for i in L[0]]) + '\n')
-                    elif L[0][9] > L[1][9]:
-                        num_match += 1
-                        o.write(q + '\t' + chr_hits[0] + '\t' + \
-                           '\t'.join([str(i) for i in L[0]]) + '\n')
-                    elif L[0][9] < L[1][9]:
-                        num_match += 1
-                        o.write(q + '\t' + chr_hits[0] + '\t' + \
-                           '\t'.join([str(i) for i in L[0]]) + '\n')
-                    elif len(set([i[8] for i in L])) == 1: 
-                        choice = random.sample(L,1).pop()
-                        num_match += 1
-                        o.write(q + '\t' + chr_hits[0] + '\t' + \
-                           '\t'.join([str(i) for i in choice]) + '\n')
-                    else: continue
-            # Deal with sequences that blast to multiple scaffolds
-            # finding the scaffold with the minimum sum e-value
-            else:
-                curr_sums = {} 
-                for c in chr_hits:
-                    if c not in curr_sums: 
-                        curr_sums[c] = 0
-                    curr_data = dic[q][c]
-                    curr_sums[c] += sum([i[8] for i in curr_data])
-                
-                L = sorted(curr_sums.iteritems(), key=itemgetter(1))
-                
-                if L[0][1] < L[1][1]:
-                    best_ch = L[0][0]
-                    
-                    best_scaff = dic[q][best_ch]
-                    
-                    if len(best_scaff) == 1:
-                        
-                        num_match += 1
-                        o.write(q + '\t' + best_ch + '\t' + \
-                               '\t'.join([str(i) for i in best_scaff[0]]) + '\n')
-                    
-                    else:
-                        K = sorted(best_scaff, key=itemgetter(8))
-                    
-                        if len(set([i[8] for i in K[0:2]])) == 2:
-                            num_match += 1
-                            o.write(q + '\t' + L[0][0] + '\t' + \
-                               '\t'.join([str(i) for i in K[0]]) + '\n')
-
-                        elif K[0][9] > K[1][9]:
-                            num_match += 1
-                            o.write(q + '\t' + L[0][0] + '\t' + \
-                                '\t'.join([str(i) for i in K[0]]) + '\n')
-                    
-                        elif K[0][9] < K[1][9]:
-                            num_match += 1
-                            o.write(q + '\t' + L[0][0] + '\t' + \
-                                '\t'.join([str(i) for i in K[0]]) + '\n')
-                   
-                        elif len(set([i[8] for i in K])) == 1: 
-                            choice = random.sample(K,1).pop()
-                            num_match += 1
-                            o.write(q + '\t' + L[0][0] + '\t' + \
-                                '\t'.join([str(i) for i in choice]) + '\n')
-            
-                        else: continue
-    
+    with open(part_fil, 'wb') as o:
+        for q, hits in queries:
+            best = best_hit(q, hits)
+            if best is None: continue
+            num_match += 1
+            o.write(q + '\t' + best[0] + '\t' + format_hit(best[1]) + '\n')
+
     print "Number of best hits:", num_match
  
 if __name__ == '__main__':
     start = time.time()
-    if len(sys.argv) != 3:
+    modes = ('memory', 'stream', 'grouped', 'sort')
+    if len(sys.argv) not in (3, 4, 5) or (len(sys.argv) > 3 and sys.argv[3] not in modes):
         print main.__doc__
         sys.exit()
     blast_fil = sys.argv[1]
     out_fil   = sys.argv[2]
+    part_fil  = out_fil + '.part'
+    mode      = sys.argv[3] if len(sys.argv) > 3 else 'memory'
+    seed      = int(sys.argv[4]) if len(sys.argv) > 4 else 0
     main()
     print "Finished; Took:", time.time() - start, "seconds."
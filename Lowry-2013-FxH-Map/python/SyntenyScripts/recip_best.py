@@ -12,11 +12,17 @@
 # You should have received a copy of the CC0 Public Domain Dedication along with 
 # this software. If not, see <http://creativecommons.org/publicdomain/zero/1.0/>
 #
+import os
 import time
 import sys
 from operator import itemgetter
 import random
 import collections
+import blasttab
+import extsort
+
+# FH best hit files larger than this are joined on disk in the auto mode
+max_hash_bytes = 200 * 1024 * 1024
 
 def main():
     """
@@ -27,29 +33,38 @@ def main():
     Parses out the reciprocal best hits from filtered Blast hits via ParseBlast.py.
     ---------------------------------------------------------------------------
 
-    USAGE: RecipBest.py fh_fox_best.tab fox_fh_best.tab out.tab
+    USAGE: RecipBest.py fh_fox_best.tab fox_fh_best.tab out.tab [auto|hash|merge]
 
     ARGUMENTS:
          fh_fox_best.tab - tab delimited best hits file of fh blasted onto Foxtail 
          fox_fh_best.tab - tab delimited best hits file of fox blasted onto FH
          out.tab   - tab delimited best hits file
+         join      - how the two files are joined (default auto):
+                     hash  - the FH hits are held in memory
+                     merge - both files are sorted on the join key on disk
+                             ($TMPDIR) and merge joined, for files that do
+                             not fit in memory
+                     auto  - merge when fh_fox_best.tab is over 200Mb
+                     Both joins write the same file.
     """
-    FH_dict = build_FH()
-    process_Fox(FH_dict)
+    if join == 'merge' or \
+       (join == 'auto' and os.path.getsize(fh_fox_fil) > max_hash_bytes):
+        merge_join()
+    else:
+        FH_dict = build_FH()
+        process_Fox(FH_dict)
 
 def build_FH():
     """
     Creates the dictionary of FH best hits on foxtail 
     """
     dic = {} 
-    with open(fh_fox_fil, 'rU') as f:
-        for line in f:
-            cols   = line.rstrip().split('\t')
-            query  = cols[0]
-            target = cols[1]
-
-            if query not in dic: dic[query] = {}
-            dic[query][target] = ''
+    for hit in blasttab.parse(blasttab.lines(fh_fox_fil)):
+        query  = hit.query
+        target = hit.subject
+
+        if query not in dic: dic[query] = {}
+        dic[query][target] = ''
     return dic
 
 def process_Fox(dic):
@@ -60,30 +75,78 @@ def process_Fox(dic):
     b_dic = {}
     o = open(out_fil, 'wb')
 
-    with open(fox_fh_fil, 'rU') as f:
-        for line in f:
-            cols   = line.rstrip().split('\t')
-            query  = cols[0]
-            target = cols[1]
-            evalue = float(cols[10])
+    for hit in blasttab.parse(blasttab.lines(fox_fh_fil)):
+        query  = hit.query
+        target = hit.subject
 
-            ch = query.split('_')[0]
-            if target in dic:
-                if ch in dic[target]:
-                    num_match += 1
-                    tvals = target.split('_')
-                    o.write(ch + '\t' + '\t'.join(tvals) + '\n') 
+        ch = query.split('_')[0]
+        if target in dic:
+            if ch in dic[target]:
+                num_match += 1
+                tvals = target.split('_')
+                o.write(ch + '\t' + '\t'.join(tvals) + '\n') 
 
     o.close()    
     print "Number of best hits:", num_match
+
+def join_key(line):
+    """
+    Sort key of the (FH scaffold, Foxtail chromosome) pair leading a line
+    """
+    return line.rstrip('\n').split('\t', 2)[:2]
+
+def FH_pairs():
+    """
+    Yields the (FH scaffold, chromosome) pairs of the FH best hits as lines
+    """
+    for hit in blasttab.parse(blasttab.lines(fh_fox_fil)):
+        yield hit.query + '\t' + hit.subject + '\n'
+
+def Fox_pairs():
+    """
+    Yields the (FH scaffold, chromosome, line number) of the Foxtail best
+    hits as lines
+    """
+    for n, hit in enumerate(blasttab.parse(blasttab.lines(fox_fh_fil))):
+        ch = hit.query.split('_')[0]
+        yield '{0}\t{1}\t{2:012d}\n'.format(hit.subject, ch, n)
+
+def merge_join():
+    """
+    Sorts both best hit files on (FH scaffold, chromosome) and joins them
+    in one pass. The matches are sorted back into the order of the Foxtail
+    file.
+    """
+    num_match = 0
+    fh  = extsort.sort_lines(FH_pairs(), key=join_key)
+    fox = extsort.sort_lines(Fox_pairs(), key=join_key)
+
+    def matches():
+        curr = next(fh, None)
+        for line in fox:
+            target, ch, n = line.rstrip('\n').split('\t')
+            key = [target, ch]
+            while curr is not None and join_key(curr) < key:
+                curr = next(fh, None)
+            if curr is None: break
+            if join_key(curr) == key:
+                yield n + '\t' + ch + '\t' + '\t'.join(target.split('_')) + '\n'
+
+    with open(out_fil, 'wb') as o:
+        for line in extsort.sort_lines(matches()):
+            num_match += 1
+            o.write(line.split('\t', 1)[1])
+    print "Number of best hits:", num_match
  
 if __name__ == '__main__':
     start = time.time()
-    if len(sys.argv) != 4:
+    if len(sys.argv) not in (4, 5) or \
+       (len(sys.argv) == 5 and sys.argv[4] not in ('auto', 'hash', 'merge')):
         print main.__doc__
         sys.exit()
     fh_fox_fil = sys.argv[1]
     fox_fh_fil = sys.argv[2]
     out_fil    = sys.argv[3]
+    join       = sys.argv[4] if len(sys.argv) == 5 else 'auto'
     main()
     print "Finished; Took:", time.time() - start, "seconds."